@@ -1,16 +1,30 @@
 
-from transit import TransitFeed, Route, Vehicle, Stop, Trip
-from strip_config import LightStop, StripConfig, LightStatus, BoundingArea
-import os
 import time
-import board
-import neopixel_spi
-import sqlite3
-import pandas as pd
-from google.transit import gtfs_realtime_pb2
-import requests
-from protobuf_to_dict import protobuf_to_dict
-from flatten_json import flatten
+# Time to first frame is measured from here
+boot_time = time.monotonic()
+from transit import print_stopwatch
+from strip_config import LightStatus, palette, light_colors, stop_radius
+import os
+import sys
+import signal
+import atexit
+import threading
+import asyncio
+from realtime import decode_vehicle_positions
+from fetcher import FeedFetcher
+from gtfs_db import GtfsDatabase
+from frames import group_vehicles, compute_motion, paint
+from motion import MotionFrame, Staleness
+from feed_cache import save_batch, load_batch
+from snapshot import load_static, save_static
+from pipeline import Pipeline
+from scheduler import PollScheduler
+from worker import DecodeWorker
+from framebuffer import Framebuffer
+from output import OutputDriver
+from refresher import StaticRefresher
+from watcher import ConfigWatcher
+from metrics import metrics, MetricsServer, StatsDumper
 import json
 
 from dotenv import main
@@ -20,25 +34,41 @@ main.load_dotenv()
 static_url = 'https://metro.kingcounty.gov/GTFS/google_transit.zip'
 realtime_url = 'https://s3.amazonaws.com/kcm-alerts-realtime-prod/vehiclepositions.pb'
 
-conn = sqlite3.connect(os.getenv('gtfs_db'))
-stop_radius = 0.002
+gtfs_db = os.getenv('gtfs_db')
+# Hydrated routes and compiled layout, rebuilt whenever gtfs_db or strips.json change. Defaults to gtfs_db + '.snapshot'
+static_snapshot = os.getenv('static_snapshot')
 loop_sleep = 8
+# Last decoded feed, shown straight away on the next start. Defaults to gtfs_db + '.feed'
+feed_cache = os.getenv('feed_cache', '{}.feed'.format(gtfs_db))
+# Vehicles fade once the feed is a minute old and are hidden after max_staleness seconds
+max_staleness = float(os.getenv('max_staleness', 600))
+# Vehicles are moved along by dead reckoning between polls, frame_rate times a second
+frame_rate = 30
+frame_interval = 1 / frame_rate
+# Instrumentation is off unless one of these is set, e.g. metrics_port=9108 or metrics_dump=/tmp/ledmap-stats.json
+metrics_port = os.getenv('metrics_port')
+metrics_dump = os.getenv('metrics_dump')
+metrics_dump_interval = 60
+# Fetch and decode in a separate process when set, e.g. decode_worker=1, see worker.py
+decode_worker = os.getenv('decode_worker')
+# How often the render process looks for a new frame from the worker
+worker_poll_interval = 0.25
 
 # 2 line #0x00A0DF
 local_path = '/tmp/gtfs'
 # pixels = neopixel.NeoPixel(board.D10, 10)
-light_colors = {
-    LightStatus.EMPTY: 0x000000,
-    LightStatus.STATION: 0xFFD700,
-    LightStatus.OCCUPIED: 0x3DAE2B
-}
+colors = palette(light_colors)
+staleness = Staleness(colors, [LightStatus.OCCUPIED.value], limit=max_staleness)
 with open('strips.json') as json_data:
     led_config = json.load(json_data)
 os.makedirs(os.path.dirname(local_path), exist_ok=True)
 
-strips= {
-    1: neopixel_spi.NeoPixel_SPI(board.SPI(), 10, brightness=0.1)
-}
+with open('output.json') as json_data:
+    output_config = json.load(json_data)
+
+# Pixels are only pushed through the framebuffer, one show() per changed strip
+output = OutputDriver.FromConfig(output_config)
+framebuffer = Framebuffer(output.lengths(), light_colors.get(LightStatus.EMPTY))
 
 
 def printStops(stopArr):
@@ -52,194 +82,149 @@ def printStops(stopArr):
     str = '[ ' + '|'.join(occupiedArr) + ' ]'
     print(str)
 
-def clear_lights():
-    color = light_colors.get(LightStatus.EMPTY)
-    for strip_idx in strips:
-        strip = strips.get(strip_idx)
-        if (strip is not None):
-            strip.fill(color)
-
-def set_single_led(led_code: str, status: LightStatus):
-    color = light_colors.get(status)
-    arr = led_code.split(':')
-    strip_index = int(arr[0])
-    strip = strips.get(strip_index)
-    led_index = int(arr[1])
-    if strip is not None:
-        strip[led_index] = color
-
-def filter_led_config_direction(arr, direction_id):
-    for item in arr:
-        if item.get('direction') == direction_id:
-            return item
-    return None
-
-def find_stop_by_stop_code(arr, stop_code):
-    for item in arr:
-        if item.get('code') == int(stop_code):
-            return item
-    return None
-
-def get_stop_config_by_stop_code(route_short_name, direction, stop_code):
-    line_directions = led_config.get(route_short_name)
-    if line_directions is None:
-        return None
-    directional_stops = filter_led_config_direction(line_directions, direction)
-    if (directional_stops is None):
-        return None
-    return find_stop_by_stop_code(directional_stops.get('stops'), stop_code)
-
-def get_prev_stop_config_by_current_stop_code(route_short_name, direction, stop_code):
-    line_directions = led_config.get(route_short_name)
-    if line_directions is None:
-        return None
-    directional_stops = filter_led_config_direction(line_directions, direction)
-    if (directional_stops is None):
-        return None
-    arr = directional_stops.get('stops')
-    for index, item in enumerate(arr):
-        if item.get('code') == int(stop_code):
-            return None if index == 0 else arr[index - 1]
-
-def get_route_by_id(route_id):
-    route_df = pd.read_sql_query("SELECT * FROM routes r where r.route_id = '{}'".format(route_id), conn)
-    return Route(route_df.iloc[0])
-
-def get_route_by_name(name):
-    route_df = pd.read_sql_query("SELECT * FROM routes r where r.route_short_name = '{}'".format(name), conn)
-    return Route(route_df.iloc[0])
-
-def get_trip_by_id(trip_id):
-    trip_df = pd.read_sql_query("SELECT * FROM trips t where t.trip_id = '{}'".format(trip_id), conn)
-    return Trip(trip_df.iloc[0])
-
-def get_stops_by_route_id(route_id):
-    stops_df = pd.read_sql_query("SELECT s.* FROM routes r JOIN route_stops rs ON rs.route_id = r.route_id JOIN stops s ON rs.stop_id = s.stop_id WHERE r.route_id = {}".format(route_id), conn)
-    stops = []
-    for stop_idx, stop in stops_df.iterrows():
-        stops.append(Stop(stop))
-    return stops
-
-def get_stop_by_code(stop_code):
-    stops_df = pd.read_sql_query("SELECT * FROM stops s WHERE s.stop_code = '{}'".format(stop_code), conn)
-    return Stop(stops_df.iloc[0])
-
-def hydrate_routes():
-    hydrated_routes = {}
-    for route_name in led_config:
-        route = get_route_by_name(route_name)
-        route_id = int(route.id)
-        hydrated_routes[route_id] = route
-        stops = get_stops_by_route_id(route_id)
-        route.SetStops(stops)
-
-    return hydrated_routes
-
-routes_by_id = hydrate_routes()
-
-def get_all_route_stops(route_short_name):
-    line_directions = led_config.get(route_short_name)
-    if line_directions is None:
-        return None
-    all_stops = []
-    for directional_config in line_directions:
-        direction_stops = directional_config.get('stops')
-        for stop in direction_stops:
-            all_stops.append(stop)
-    return all_stops
+def open_gtfs_db(path):
+    db = GtfsDatabase(path)
+    db.ensure_indexes()
+    return db
+
+start_time = time.time()
+static, from_snapshot = load_static(open_gtfs_db(gtfs_db), led_config, output.lengths(), stop_radius, static_snapshot)
+print_stopwatch(time.time() - start_time, 'Loaded static data from snapshot' if from_snapshot else 'Built static data')
+
+worker = None
+pipeline = None
+# The feed's timestamp and vehicles behind the latest frame, placed again when the layout changes
+last_vehicles = None
+# The refresher and the strips.json watcher each replace static
+static_lock = threading.Lock()
+
+def reload_static(db_path):
+    # Runs on the refresher thread, the loop picks up the new object on its next frame
+    global static
+    start_time = time.time()
+    with static_lock:
+        data, _ = load_static(open_gtfs_db(db_path), led_config, output.lengths(), stop_radius, static_snapshot)
+        if worker is not None:
+            # The new worker loads the snapshot load_static just wrote
+            worker.restart(data)
+        static = data
+    print_stopwatch(time.time() - start_time, 'Reloaded static data')
+
+def reload_layout(config):
+    # Runs on the watcher thread, only routes whose strips.json entry changed are rebuilt
+    global static, led_config
+    start_time = time.time()
+    with static_lock:
+        try:
+            data = static.reconfigure(config)
+        except (ValueError, LookupError, TypeError) as e:
+            print('Keeping the current layout, strips.json is invalid: {}'.format(e))
+            return
+        if data is static:
+            return
+        led_config = config
+        static = data
+        if worker is None and last_vehicles is not None and pipeline is not None:
+            reported, vehicles_by_route = last_vehicles
+            pipeline.replace_frame(compute_motion(data, vehicles_by_route, log=None, reported=reported))
+        print_stopwatch(time.time() - start_time, 'Reloaded strips.json')
+        # Next start, and a restarted worker, pick the new layout up from the snapshot
+        save_static(data, static_snapshot)
+        if worker is not None:
+            worker.restart(data)
+
+fetcher = FeedFetcher(realtime_url)
+# Polls follow the feed's own publish cadence and slow down outside the routes' service hours
+scheduler = PollScheduler(fetcher, loop_sleep, service=lambda: static.service)
 
 def get_latest_feed():
-    feed = gtfs_realtime_pb2.FeedMessage()
-    response = requests.get(realtime_url, allow_redirects=True)
-    feed.ParseFromString(response.content)
-
-    dict = protobuf_to_dict(feed)
-
-    zet_df = pd.DataFrame(flatten(record, '.')
-        for record in dict['entity'])
-
-    vehicles_by_route = {}
-    for index, row in zet_df.iterrows():
-        vehicle = Vehicle(row)
-
-        route: Route = routes_by_id.get(vehicle.route_id)
-        # We don't care about this route
-        if route is None:
-            continue
-        trip = get_trip_by_id(int(vehicle.trip_id))
-        route_vehicles = vehicles_by_route.get(route.short_name)
-        if (route_vehicles is None):
-            vehicles_by_route[route.short_name] = []
-            route_vehicles = vehicles_by_route.get(route.short_name)
-
-        route_vehicles.append({
-            "route": route,
-            "trip": trip,
-            "vehicle": vehicle
-        })
-    return vehicles_by_route
-
-def find_largest_object(objects, target_percentage):
-    # Initialize the best object and best percentage
-    best_object = None
-    best_percentage = -1
-    closest_object = None
-    
-    for obj in objects:
-        led_percentage = float(obj.get('percentage'))
-        
-        # Track the closest object if no valid one is found
-        if closest_object is None or led_percentage < closest_object.get('percentage'):
-            closest_object = obj
-        
-        if led_percentage <= target_percentage:
-            if led_percentage > best_percentage:
-                best_object = obj
-                best_percentage = led_percentage
-    
-    # If no object was found within the target, return the closest one
-    return best_object if best_object else closest_object
-
-
-while(True):
-
-    vehicles_by_route = get_latest_feed()
-
-    # pixels.fill((0, 0, 0))
-
-    for route_short_name in led_config:
-        route_config = led_config.get(route_short_name)
-        vehicles = vehicles_by_route.get(route_short_name)
-
-        clear_lights()
-
-        route_stops = get_all_route_stops(route_short_name)
-        for route_stop in route_stops:
-            set_single_led(route_stop.get('led'), LightStatus.STATION)
-
-        for vehicle_item in vehicles:
-            vehicle: Vehicle = vehicle_item.get('vehicle')
-            route: Route = vehicle_item.get('route')
-            stop: Stop = route.stops.get(vehicle.stop_id)
-            stop_bounding_area = BoundingArea.FromPoint(stop.latitude, stop.longitude, stop_radius)
-            vehicle_is_at_stop = stop_bounding_area.contains(vehicle.latitude, vehicle.longitude)
-            stop_config = get_stop_config_by_stop_code(route.short_name, vehicle.direction_id, stop.code)
-            label = 'is at' if vehicle_is_at_stop else 'is heading to'
-            if stop_config is not None:
-                print('Vehicle {} {} stop {}'.format(vehicle.label, label, stop.name))
-                if vehicle_is_at_stop:
-                    set_single_led(stop_config.get('led'), LightStatus.OCCUPIED)
-                else:
-                    # Calculate the distance from the last stop to this one
-                    prev_stop_config = get_prev_stop_config_by_current_stop_code(route.short_name, vehicle.direction_id, stop.code)
-                    if (prev_stop_config is None):
-                        continue
-                    prev_stop = get_stop_by_code(prev_stop_config.get('code'))
-                    prev_bounding_area = BoundingArea.FromPoint(prev_stop.latitude, prev_stop.longitude, stop_radius)
-                    percentage = stop_bounding_area.calculate_percentage(prev_bounding_area, (vehicle.latitude, vehicle.longitude))
-                    # We know we're not at the stop, now just figure out which light to light up
-                    led = find_largest_object(stop_config.get('loading'), percentage)
-                    if led is not None:
-                        set_single_led(led.get('led'), LightStatus.OCCUPIED)
-    time.sleep(loop_sleep)
-
+    feed = fetcher.poll()
+    if feed is None:
+        # Nothing new since the last poll, keep showing the current frame
+        return None
+    data = static
+    # Only vehicles on routes we have hydrated are decoded at all
+    with metrics.time('filter'):
+        batch = decode_vehicle_positions(feed, data.routes_by_id.keys())
+    metrics.count('vehicles_decoded', len(batch))
+    try:
+        save_batch(feed_cache, batch)
+    except OSError as e:
+        print('Could not write feed cache {}: {}'.format(feed_cache, e))
+    with metrics.time('resolve'):
+        return batch.timestamp, group_vehicles(data, batch)
+
+def compute(latest):
+    global last_vehicles
+    last_vehicles = latest
+    reported, vehicles_by_route = latest
+    with metrics.time('compute'):
+        return compute_motion(static, vehicles_by_route, reported=reported)
+
+def compute_worker_frame(latest):
+    data, arrays = latest
+    with metrics.time('compute'):
+        return MotionFrame(data.strips, *arrays)
+
+def render_frame(motion):
+    now = time.time()
+    frame_colors = staleness.palette(motion.age(now))
+    with metrics.time('paint'):
+        if frame_colors is None:
+            # Too old to say where anything is, only the stations stay up
+            paint(framebuffer, motion.strips.calculate_strip((), (), ()), colors)
+        else:
+            paint(framebuffer, motion.at(now), frame_colors)
+    with metrics.time('flush'):
+        output.push(framebuffer)
+
+
+# Stations go up straight away, with the vehicles of the cached feed if there is one
+cached = load_batch(feed_cache, static.routes_by_id.keys())
+if cached is not None:
+    last_vehicles = (cached.timestamp, group_vehicles(static, cached))
+    first_frame = compute_motion(static, last_vehicles[1], log=None, reported=cached.timestamp)
+else:
+    first_frame = compute_motion(static, {}, log=None)
+render_frame(first_frame)
+print_stopwatch(time.monotonic() - boot_time, 'First frame')
+
+if decode_worker:
+    # The worker loads the snapshot load_static left behind, see worker.py
+    worker_args = ['--url', realtime_url, '--interval', str(loop_sleep), '--feed-cache', feed_cache]
+    worker = DecodeWorker(worker_args, static_snapshot).start(static)
+    atexit.register(worker.stop)
+    pipeline = Pipeline(worker.latest, compute_worker_frame, render_frame,
+                        poll_interval=worker_poll_interval, frame_interval=frame_interval, animate=True, initial=first_frame)
+else:
+    pipeline = Pipeline(get_latest_feed, compute, render_frame,
+                        poll_interval=loop_sleep, frame_interval=frame_interval, animate=True, scheduler=scheduler,
+                        initial=first_frame)
+refresher = StaticRefresher(static_url, gtfs_db, reload_static).start()
+config_watcher = ConfigWatcher('strips.json', reload_layout).start()
+
+if metrics_port or metrics_dump:
+    metrics.enabled = True
+    if worker is not None:
+        # The fetch to compute stages run in the worker, it times them and hands them over in the ring
+        metrics.register('worker', worker.stats)
+        metrics.register_stages('worker', worker.stage_histograms)
+    else:
+        metrics.register('fetcher', fetcher.stats)
+        metrics.register('scheduler', scheduler.stats)
+    metrics.register('pipeline', pipeline.stats)
+    metrics.register('config', config_watcher.stats)
+    metrics.register('output', output.stats)
+    metrics.register('trips', lambda: static.trip_index.stats())
+    metrics.register('queries', lambda: static.db.query_stats())
+    if metrics_port:
+        MetricsServer(metrics, int(metrics_port)).start()
+    if metrics_dump:
+        StatsDumper(metrics, metrics_dump, metrics_dump_interval).start()
+
+def on_sigterm(signum, frame):
+    # Exit like on Ctrl-C, so the atexit handlers stop the decode worker
+    sys.exit(128 + signum)
+
+signal.signal(signal.SIGTERM, on_sigterm)
+asyncio.run(pipeline.run())
@@ -0,0 +1,74 @@
+"""
+Compares the old protobuf_to_dict/flatten/DataFrame path against the columnar
+decoder on a recorded VehiclePositions feed.
+
+    python benchmarks/bench_decoder.py vehiclepositions.pb --routes 102615 --runs 20
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pandas as pd
+from protobuf_to_dict import protobuf_to_dict
+from flatten_json import flatten
+from transit import Vehicle
+from realtime import parse_feed, decode_vehicle_positions
+
+
+def legacy_path(content, route_ids):
+    feed = parse_feed(content)
+    dict = protobuf_to_dict(feed)
+    zet_df = pd.DataFrame(flatten(record, '.')
+        for record in dict['entity'])
+    vehicles = []
+    for index, row in zet_df.iterrows():
+        vehicle = Vehicle(row)
+        if vehicle.route_id not in route_ids:
+            continue
+        vehicles.append(vehicle)
+    return vehicles
+
+
+def columnar_path(content, route_ids):
+    feed = parse_feed(content)
+    batch = decode_vehicle_positions(feed, route_ids)
+    return [Vehicle(row) for row in batch.rows()]
+
+
+def time_runs(func, content, route_ids, runs):
+    timings = []
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func(content, route_ids)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return result, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('feed', help='Recorded vehiclepositions.pb')
+    parser.add_argument('--routes', type=int, nargs='+', required=True, help='route_ids to keep')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    with open(args.feed, 'rb') as feed_file:
+        content = feed_file.read()
+    route_ids = set(args.routes)
+
+    print('Feed: {} bytes, {} entities'.format(len(content), len(parse_feed(content).entity)))
+    results = {}
+    for name, func in (('legacy', legacy_path), ('columnar', columnar_path)):
+        vehicles, timings = time_runs(func, content, route_ids, args.runs)
+        results[name] = timings[len(timings) // 2]
+        print('{:>9}: {} vehicles, median {:.2f} ms, best {:.2f} ms'.format(
+            name, len(vehicles), results[name] * 1000, timings[0] * 1000))
+    print('Speedup: {:.1f}x'.format(results['legacy'] / results['columnar']))
+
+
+if __name__ == '__main__':
+    main()
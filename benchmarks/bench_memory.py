@@ -0,0 +1,128 @@
+"""
+Memory held by TransitFeed.ParseStaticFeed's model objects, before and after the
+move to slotted classes and the TripTable/StopTimeTable column stores.
+
+Each mode runs in its own process, so peak RSS is measured cleanly too.
+
+    python benchmarks/bench_memory.py --zip google_transit.zip
+    python benchmarks/bench_memory.py --synthetic-trips 2000
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pandas as pd
+import transit
+from transit import TransitFeed
+
+
+def unslotted(cls):
+    # The same class with a per-instance __dict__, which is what the models used to be
+    namespace = {key: value for key, value in cls.__dict__.items()
+                 if key not in getattr(cls, '__slots__', ()) and key not in ('__slots__', '__dict__', '__weakref__')}
+    return type(cls.__name__, (), namespace)
+
+
+def legacy_parse(local_path):
+    # ParseStaticFeed as it was: a Trip for every trip and a TripStop for every stop_times row.
+    # Rows are converted a chunk at a time instead of with iterrows(), which only changes how long it takes.
+    Route = unslotted(transit.Route)
+    Trip = unslotted(transit.Trip)
+    TripStop = unslotted(transit.TripStop)
+    Stop = unslotted(transit.Stop)
+    routes = {}
+    trips = {}
+    for row in pd.read_csv(local_path + '/routes.txt').to_dict('records'):
+        route = Route(row)
+        routes[route.id] = route
+    for row in pd.read_csv(local_path + '/trips.txt').to_dict('records'):
+        trip = Trip(row)
+        trips[trip.id] = trip
+        routes[trip.route_id].trips[trip.id] = trip
+    for chunk in pd.read_csv(local_path + '/stop_times.txt', chunksize=200000):
+        for row in chunk.to_dict('records'):
+            trip_stop = TripStop(row)
+            trips[trip_stop.trip_id].trip_stops[trip_stop.stop_id] = trip_stop
+    stops = {}
+    for row in pd.read_csv(local_path + '/stops.txt').to_dict('records'):
+        stop = Stop(row)
+        stops[stop.id] = stop
+    return routes, trips, stops
+
+
+def compact_parse(local_path):
+    feed = TransitFeed(None, None, local_path)
+    feed.ParseStaticFeed()
+    return feed
+
+
+def measure(mode, local_path):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    kept = legacy_parse(local_path) if mode == 'legacy' else compact_parse(local_path)
+    elapsed = time.perf_counter() - start_time
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = sum(1 for _ in open(local_path + '/stop_times.txt')) - 1
+    del kept
+    return {
+        'mode': mode,
+        'stop_times': rows,
+        'seconds': elapsed,
+        'retained_mb': current / 1e6,
+        'peak_mb': peak / 1e6,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--zip', help='GTFS zip, e.g. King County Metro\'s google_transit.zip')
+    parser.add_argument('--synthetic-trips', type=int, default=1000, help='Trips per direction of the synthetic network when no --zip is given')
+    parser.add_argument('--mode', choices=['legacy', 'compact'], help=argparse.SUPPRESS)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        # Child process, prints one JSON line
+        print(json.dumps(measure(args.mode, args.dir)))
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.zip:
+            with zipfile.ZipFile(args.zip) as archive:
+                archive.extractall(workdir)
+        else:
+            from synthetic import Network
+            zip_path = os.path.join(workdir, 'synthetic.zip')
+            with open(zip_path, 'wb') as zip_file:
+                zip_file.write(Network(2000, trips=args.synthetic_trips).gtfs_zip())
+            with zipfile.ZipFile(zip_path) as archive:
+                archive.extractall(workdir)
+
+        results = []
+        for mode in ('legacy', 'compact'):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode, '--dir', workdir],
+                                    check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print('{} stop_times rows'.format(results[0]['stop_times']))
+    print('{:>8} {:>10} {:>12} {:>10} {:>12}'.format('mode', 'seconds', 'retained MB', 'peak MB', 'max RSS MB'))
+    for result in results:
+        print('{:>8} {:>10.2f} {:>12.1f} {:>10.1f} {:>12.1f}'.format(
+            result['mode'], result['seconds'], result['retained_mb'], result['peak_mb'], result['max_rss_mb']))
+    legacy, compact = results
+    print('retained memory {:.1f}x smaller'.format(legacy['retained_mb'] / max(compact['retained_mb'], 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
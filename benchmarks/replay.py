@@ -0,0 +1,173 @@
+"""
+Replays VehiclePositions snapshots through the real pipeline, offline, against an
+in-memory strip backend, and reports per-stage latency percentiles and peak RSS.
+Every synthetic scenario runs in its own process, so its peak RSS is its own,
+protobuf's native allocations included.
+
+Synthetic scale-up (default matrix is 10/1,000/20,000 vehicles x 10/200/2,000 LEDs):
+
+    python benchmarks/replay.py --synthetic
+    python benchmarks/replay.py --synthetic --vehicles 20000 --leds 2000 --runs 50
+
+Recorded feeds against a real gtfs_db and layout:
+
+    python benchmarks/replay.py --feeds feeds/*.pb --gtfs-db gtfs.db --strips strips.json --output output.json
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from strip_config import LightStatus, palette, light_colors, stop_radius
+from realtime import parse_feed, decode_vehicle_positions
+from gtfs_db import GtfsDatabase
+from frames import StaticData, group_vehicles, compute_frame, paint
+from framebuffer import Framebuffer
+from output import OutputDriver
+from synthetic import Network
+
+stages = ('parse', 'decode', 'group', 'compute', 'paint', 'push')
+colors = palette(light_colors)
+
+
+class Scenario:
+    def __init__(self, name, data, strip_lengths, snapshots):
+        self.name = name
+        self.data = data
+        self.strip_lengths = strip_lengths
+        self.snapshots = snapshots
+
+
+def run_once(scenario, content, framebuffer, output, timings):
+    data = scenario.data
+    marks = [time.perf_counter()]
+    feed = parse_feed(content)
+    marks.append(time.perf_counter())
+    batch = decode_vehicle_positions(feed, data.routes_by_id.keys())
+    marks.append(time.perf_counter())
+    vehicles_by_route = group_vehicles(data, batch)
+    marks.append(time.perf_counter())
+    frame = compute_frame(data, vehicles_by_route, log=None)
+    marks.append(time.perf_counter())
+    paint(framebuffer, frame, colors)
+    marks.append(time.perf_counter())
+    output.push(framebuffer)
+    marks.append(time.perf_counter())
+    for stage, start, end in zip(stages, marks, marks[1:]):
+        timings[stage].append(end - start)
+    timings['total'].append(marks[-1] - marks[0])
+    return len(batch)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def replay(scenario, runs):
+    framebuffer = Framebuffer(scenario.strip_lengths, light_colors.get(LightStatus.EMPTY))
+    output = OutputDriver.InMemory(scenario.strip_lengths)
+    timings = {stage: [] for stage in stages + ('total',)}
+    decoded = 0
+    for run in range(runs):
+        decoded = run_once(scenario, scenario.snapshots[run % len(scenario.snapshots)], framebuffer, output, timings)
+    # Peak RSS of this process in KiB on Linux, tracemalloc can't see what the protobuf parser allocates
+    return timings, decoded, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def report(scenario, timings, decoded, peak):
+    led_count = sum(len(stop.loading_leds) + 1 for stop in scenario.data.layout.stops.values())
+    print('\n{} ({} LEDs, {} vehicles decoded, peak RSS {:.1f} MiB)'.format(scenario.name, led_count, decoded, peak / 1024))
+    print('  {:>8} {:>9} {:>9} {:>9} {:>9}'.format('stage', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for stage in stages + ('total',):
+        values = sorted(timings[stage])
+        print('  {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+            stage, percentile(values, 0.5) * 1000, percentile(values, 0.95) * 1000,
+            percentile(values, 0.99) * 1000, values[-1] * 1000))
+
+
+def synthetic_database(workdir, led_count):
+    db_path = os.path.join(workdir, 'synthetic-{}.db'.format(led_count))
+    if not os.path.exists(db_path):
+        Network(led_count).build_database(db_path)
+    return db_path
+
+
+def synthetic_scenario(workdir, vehicle_count, led_count, snapshot_count):
+    network = Network(led_count)
+    led_config, led_total = network.led_config()
+    strip_lengths = network.strip_lengths(led_total)
+    db_path = synthetic_database(workdir, led_count)
+    data = StaticData(GtfsDatabase(db_path), led_config, strip_lengths, stop_radius)
+    snapshots = [network.feed(vehicle_count, seed=seed, timestamp=1700000000 + seed * 10) for seed in range(snapshot_count)]
+    return Scenario('{} vehicles x {} LEDs'.format(vehicle_count, led_total), data, strip_lengths, snapshots)
+
+
+def recorded_scenario(args):
+    with open(args.strips) as json_data:
+        led_config = json.load(json_data)
+    with open(args.output) as json_data:
+        strip_lengths = {int(strip['id']): int(strip['length']) for strip in json.load(json_data).get('strips', [])}
+    snapshots = []
+    for path in args.feeds:
+        with open(path, 'rb') as feed_file:
+            snapshots.append(feed_file.read())
+    data = StaticData(GtfsDatabase(args.gtfs_db), led_config, strip_lengths, stop_radius)
+    return Scenario('{} recorded feeds'.format(len(snapshots)), data, strip_lengths, snapshots)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--synthetic', action='store_true', help='Generate networks and feeds instead of replaying recordings')
+    parser.add_argument('--vehicles', type=int, nargs='+', default=[10, 1000, 20000])
+    parser.add_argument('--leds', type=int, nargs='+', default=[10, 200, 2000])
+    parser.add_argument('--snapshots', type=int, default=5, help='Distinct synthetic feeds per scenario')
+    parser.add_argument('--feeds', nargs='+', help='Recorded vehiclepositions.pb files')
+    parser.add_argument('--gtfs-db', help='gtfs_db the recordings were taken against')
+    parser.add_argument('--strips', default='strips.json')
+    parser.add_argument('--output', default='output.json')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    parser.add_argument('--build-database', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.build_database:
+        synthetic_database(args.dir, args.leds[0])
+        return
+    if args.dir:
+        # Child process, runs the one synthetic scenario it was given
+        scenario = synthetic_scenario(args.dir, args.vehicles[0], args.leds[0], args.snapshots)
+        report(scenario, *replay(scenario, args.runs))
+        return
+
+    if not args.synthetic and not args.feeds:
+        parser.error('pass --synthetic or --feeds')
+
+    if args.feeds:
+        if args.gtfs_db is None:
+            parser.error('--feeds needs --gtfs-db')
+        scenario = recorded_scenario(args)
+        report(scenario, *replay(scenario, args.runs))
+        return
+
+    script = os.path.abspath(__file__)
+    with tempfile.TemporaryDirectory() as workdir:
+        for led_count in args.leds:
+            # Also in a process of its own: Linux children inherit the parent's peak RSS, and
+            # the scenarios' shouldn't include building the database
+            subprocess.run([sys.executable, script, '--dir', workdir, '--leds', str(led_count), '--build-database'], check=True)
+            for vehicle_count in args.vehicles:
+                subprocess.run([sys.executable, script, '--dir', workdir, '--vehicles', str(vehicle_count),
+                                '--leds', str(led_count), '--snapshots', str(args.snapshots), '--runs', str(args.runs)],
+                               check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import json
+import os
+import numpy as np
+from array import array
+from realtime import VehicleBatch
+
+# Bump whenever the columns below change
+cache_version = 1
+# (VehicleBatch attribute, array typecode or None for strings, numpy type)
+batch_columns = (
+    ('ids', None, 'U'),
+    ('trip_ids', 'q', 'i8'),
+    ('start_dates', None, 'U'),
+    ('route_ids', 'q', 'i8'),
+    ('direction_ids', 'b', 'i1'),
+    ('latitudes', 'd', 'f8'),
+    ('longitudes', 'd', 'f8'),
+    ('stop_sequences', 'q', 'i8'),
+    ('timestamps', 'q', 'i8'),
+    ('stop_ids', 'q', 'i8'),
+    ('vehicle_ids', None, 'U'),
+    ('labels', None, 'U'),
+    ('speeds', 'd', 'f8'),
+    ('statuses', 'b', 'i1'),
+)
+# The header line is padded so the records start on a multiple of this
+alignment = 64
+
+
+def batch_records(batch: VehicleBatch) -> np.ndarray:
+    fields = []
+    for name, typecode, kind in batch_columns:
+        column = getattr(batch, name)
+        if typecode is None:
+            kind = 'U{}'.format(max([len(value) for value in column] + [1]))
+        fields.append((name, kind))
+    records = np.zeros(len(batch), dtype=fields)
+    for name, _, _ in batch_columns:
+        records[name] = getattr(batch, name)
+    return records
+
+
+def save_batch(path: str, batch: VehicleBatch):
+    """
+    Writes a decoded VehicleBatch as a JSON header line followed by its rows as
+    raw numpy records, so load_batch can map them straight back in. Replaces
+    path atomically, a crash mid-write leaves the previous cache in place.
+    """
+    records = batch_records(batch)
+    header = json.dumps({'version': cache_version, 'timestamp': batch.timestamp, 'count': len(records),
+                         'fields': [[name, kind] for name, kind in records.dtype.descr]}).encode()
+    header += b' ' * (-(len(header) + 1) % alignment) + b'\n'
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as cache_file:
+        cache_file.write(header)
+        cache_file.write(records.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_batch(path: str, route_ids):
+    # The cached VehicleBatch, keeping only routes in route_ids, or None if there is no usable cache
+    try:
+        with open(path, 'rb') as cache_file:
+            header = json.loads(cache_file.readline())
+            offset = cache_file.tell()
+        if header.get('version') != cache_version:
+            return None
+        dtype = np.dtype([tuple(field) for field in header['fields']])
+        count = int(header['count'])
+        batch = VehicleBatch(int(header['timestamp']))
+        if count == 0:
+            return batch
+        records = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print('Ignoring unreadable feed cache {}: {}'.format(path, e))
+        return None
+    records = records[np.isin(records['route_ids'], np.fromiter(route_ids, dtype=np.int64))]
+    for name, typecode, _ in batch_columns:
+        values = records[name].tolist()
+        setattr(batch, name, values if typecode is None else array(typecode, values))
+    return batch
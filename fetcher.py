@@ -0,0 +1,80 @@
+import requests
+from requests.adapters import HTTPAdapter
+from realtime import parse_feed
+from metrics import metrics
+
+
+class FeedFetcher:
+    """
+    Polls a GTFS-realtime URL over one pooled session. Uses conditional requests
+    so unchanged feeds come back as 304s, and poll() returns None whenever there
+    is nothing new to decode: a 304, or a feed whose header timestamp hasn't moved.
+    """
+
+    def __init__(self, url: str, timeout=(3.05, 10), session: requests.Session = None):
+        self.url = url
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+        self.etag = None
+        self.last_modified = None
+        self.last_timestamp = None
+        self.polls = 0
+        self.bytes_fetched = 0
+        self.not_modified = 0
+        self.skipped_frames = 0
+
+    def fetch(self):
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+
+        self.polls += 1
+        with metrics.time('fetch'):
+            response = self.session.get(self.url, headers=headers, timeout=self.timeout, allow_redirects=True)
+            if response.status_code == 304:
+                self.not_modified += 1
+                return None
+            response.raise_for_status()
+            content = response.content
+
+        # Bytes as they came over the wire, before any Content-Encoding was undone
+        raw_bytes = response.raw.tell() if hasattr(response.raw, 'tell') else 0
+        self.bytes_fetched += raw_bytes or len(content)
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        return content
+
+    def poll(self):
+        etag, last_modified = self.etag, self.last_modified
+        content = self.fetch()
+        if content is None:
+            self.skipped_frames += 1
+            return None
+        try:
+            with metrics.time('parse'):
+                feed = parse_feed(content)
+        except Exception:
+            # A truncated body mustn't be answered with a 304 on the retry
+            self.etag, self.last_modified = etag, last_modified
+            raise
+        timestamp = feed.header.timestamp
+        if timestamp and timestamp == self.last_timestamp:
+            self.skipped_frames += 1
+            return None
+        self.last_timestamp = timestamp
+        return feed
+
+    def stats(self):
+        return {
+            'polls': self.polls,
+            'bytes_fetched': self.bytes_fetched,
+            'not_modified': self.not_modified,
+            'skipped_frames': self.skipped_frames,
+        }
@@ -0,0 +1,31 @@
+class Framebuffer:
+    """
+    In-memory copy of every strip. A frame is built here a strip at a time with set_strip(),
+    then OutputDriver.push() has flush_strip() write only the pixels that differ from the last
+    pushed frame and call show() once per changed strip. Strips must be created with auto_write=False.
+    """
+
+    def __init__(self, strip_lengths: dict, background: int = 0x000000):
+        self.background = background
+        self.pixels = {idx: [background] * length for idx, length in strip_lengths.items()}
+        self.pushed = {idx: None for idx in strip_lengths}
+
+    def set_strip(self, strip_index, colors: list):
+        pixels = self.pixels.get(strip_index)
+        if pixels is not None:
+            pixels[:] = colors
+
+    def dirty(self):
+        return [idx for idx, pixels in self.pixels.items() if pixels != self.pushed[idx]]
+
+    def flush_strip(self, idx, strip):
+        pixels = self.pixels[idx]
+        last = self.pushed[idx]
+        if last is None:
+            strip[:] = pixels
+        else:
+            for led_index, color in enumerate(pixels):
+                if color != last[led_index]:
+                    strip[led_index] = color
+        strip.show()
+        self.pushed[idx] = list(pixels)
@@ -0,0 +1,207 @@
+import copy
+from transit import Route, Vehicle, Stop, Trip
+from strip_config import StripConfig
+from trip_index import TripIndex
+from layout import compile_layout
+from geometry import SegmentCache
+from progress import ProgressEngine
+from spatial import SegmentGrid
+from motion import MotionFrame
+from scheduler import ServiceCalendar
+
+
+def hydrate_routes(db, led_config):
+    hydrated_routes = {}
+    for route_name in led_config:
+        route = db.get_route_by_name(route_name)
+        if route is None:
+            raise LookupError('Route {} from strips.json is not in {}'.format(route_name, db.path))
+        route_id = int(route.id)
+        hydrated_routes[route_id] = route
+        stops = db.get_stops_by_route_id(route_id)
+        route.SetStops(stops)
+
+    return hydrated_routes
+
+
+def get_stops_by_code(routes):
+    stops_by_code = {}
+    for route in routes.values():
+        for stop in route.stops.values():
+            try:
+                stops_by_code[int(stop.code)] = stop
+            except (TypeError, ValueError):
+                # Stops without a public stop_code can't be configured in strips.json
+                continue
+    return stops_by_code
+
+
+def changed_routes(old_config: dict, new_config: dict) -> set:
+    # Route names added, removed or configured differently in new_config
+    return {name for name in old_config.keys() | new_config.keys() if old_config.get(name) != new_config.get(name)}
+
+
+class StaticData:
+    # Everything derived from gtfs_db and strips.json, replaced as a single object when either changes
+    def __init__(self, db, led_config: dict, strip_lengths: dict, stop_radius: float):
+        self.db = db
+        self.led_config = led_config
+        self.strip_lengths = strip_lengths
+        self.stop_radius = stop_radius
+        self.routes_by_id = hydrate_routes(db, led_config)
+        self.trip_index = TripIndex(db)
+        self.trip_index.load_routes(self.routes_by_id.keys())
+        self.stops_by_code = get_stops_by_code(self.routes_by_id)
+        self.layout = compile_layout(led_config, strip_lengths, self.stops_by_code, stop_radius)
+        self.strips = StripConfig(self.layout, strip_lengths)
+        self.segments = SegmentCache.Build(self.layout, self.stops_by_code)
+        self.progress = ProgressEngine.Build(db, self.segments, self.shape_pairs())
+        self.grid = SegmentGrid.Build(self.layout, self.stops_by_code)
+        self.service = ServiceCalendar.Build(db, self.routes_by_id.keys())
+
+    def shape_pairs(self) -> dict:
+        # {shape_id: {(prev_code, code)}}, the configured pairs of the routes whose trips follow each shape
+        route_pairs = {}
+        for stop in self.layout.stops.values():
+            if stop.prev is not None:
+                route_pairs.setdefault(stop.route_short_name, set()).add((stop.prev.code, stop.code))
+        shape_pairs = {}
+        for trip in self.trip_index.trips.values():
+            if trip is None or trip.shape_id is None:
+                continue
+            route = self.routes_by_id.get(int(trip.route_id))
+            if route is not None:
+                shape_pairs.setdefault(trip.shape_id, set()).update(route_pairs.get(route.short_name, ()))
+        return shape_pairs
+
+    def reconfigure(self, led_config: dict):
+        """
+        StaticData for a changed strips.json, leaving this one as it is. Only the
+        routes whose config changed are hydrated and compiled again, the others
+        keep their Route, compiled stops, segments and shape polylines. Returns
+        self when no route changed. Raises LayoutError or LookupError like the
+        constructor.
+        """
+        changed = changed_routes(self.led_config, led_config)
+        if not changed:
+            return self
+        data = copy.copy(self).attach(self.db)
+        data.led_config = led_config
+        kept = {route_id: route for route_id, route in self.routes_by_id.items()
+                if route.short_name in led_config and route.short_name not in changed}
+        hydrated = hydrate_routes(self.db, {name: led_config[name] for name in changed if name in led_config})
+        data.routes_by_id = {**kept, **hydrated}
+        data.trip_index = self.trip_index.copy()
+        data.trip_index.load_routes(hydrated.keys() - self.routes_by_id.keys())
+        data.stops_by_code = get_stops_by_code(data.routes_by_id)
+        data.layout = compile_layout(led_config, self.strip_lengths, data.stops_by_code, self.stop_radius,
+                                     previous=self.layout, unchanged=led_config.keys() - changed)
+        data.strips = StripConfig(data.layout, self.strip_lengths)
+        data.segments = SegmentCache.Build(data.layout, data.stops_by_code, previous=self.segments)
+        data.progress = ProgressEngine.Build(self.db, data.segments, data.shape_pairs(), previous=self.progress)
+        data.grid = SegmentGrid.Build(data.layout, data.stops_by_code)
+        if data.routes_by_id.keys() != self.routes_by_id.keys():
+            data.service = ServiceCalendar.Build(self.db, data.routes_by_id.keys())
+        return data
+
+    def __getstate__(self):
+        # Everything but the connection is plain data, see snapshot.py
+        state = self.__dict__.copy()
+        state['db'] = None
+        return state
+
+    def attach(self, db):
+        self.db = db
+        self.trip_index.db = db
+        return self
+
+
+def group_vehicles(data, batch):
+    vehicles_by_route = {}
+    for row in batch.rows():
+        vehicle = Vehicle(row)
+
+        route: Route = data.routes_by_id.get(vehicle.route_id)
+        trip = data.trip_index.get(vehicle.trip_id)
+        route_vehicles = vehicles_by_route.get(route.short_name)
+        if (route_vehicles is None):
+            vehicles_by_route[route.short_name] = []
+            route_vehicles = vehicles_by_route.get(route.short_name)
+
+        route_vehicles.append({
+            "route": route,
+            "trip": trip,
+            "vehicle": vehicle
+        })
+    return vehicles_by_route
+
+
+def resolve_stop_code(data, route, vehicle):
+    # The feed's stop when it agrees with where the vehicle is, otherwise the nearest configured segment
+    stop = route.stops.get(vehicle.stop_id)
+    if stop is not None:
+        try:
+            code = int(stop.code)
+        except (TypeError, ValueError):
+            code = None
+        if code is not None and data.grid.is_near(route.short_name, vehicle.direction_id, code, vehicle.latitude, vehicle.longitude):
+            return code
+    return data.grid.nearest(route.short_name, vehicle.direction_id, vehicle.latitude, vehicle.longitude)
+
+
+def compute_motion(data, vehicles_by_route, log=print, reported=0) -> MotionFrame:
+    strips = data.strips
+    # StripConfig rows of stops with a vehicle at them
+    stopped = []
+    # Vehicles between stops, projected onto their segments in one batch below
+    moving = []
+    moving_rows = []
+    progress_rows = []
+    for route_short_name in data.layout.route_names():
+        vehicles = vehicles_by_route.get(route_short_name, [])
+
+        for vehicle_item in vehicles:
+            vehicle: Vehicle = vehicle_item.get('vehicle')
+            route: Route = vehicle_item.get('route')
+            trip: Trip = vehicle_item.get('trip')
+            stop_code = resolve_stop_code(data, route, vehicle)
+            if stop_code is None:
+                continue
+            stop: Stop = data.stops_by_code.get(stop_code)
+            row = strips.row(route.short_name, vehicle.direction_id, stop_code)
+            if row is not None:
+                stop_leds = strips.stops[row]
+                vehicle_is_at_stop = stop_leds.area.contains(vehicle.latitude, vehicle.longitude)
+                if log is not None:
+                    label = 'is at' if vehicle_is_at_stop else 'is heading to'
+                    log('Vehicle {} {} stop {}'.format(vehicle.label, label, stop.name))
+                prev_stop = strips.prev_stop(row)
+                if vehicle_is_at_stop:
+                    stopped.append(row)
+                elif prev_stop is not None:
+                    shape_id = None if trip is None else trip.shape_id
+                    moving.append(vehicle)
+                    moving_rows.append(row)
+                    progress_rows.append(data.progress.row(shape_id, prev_stop.code, stop_code))
+
+    if not moving:
+        return MotionFrame(strips, stopped, reported=reported)
+    percentages = data.progress.progress(progress_rows,
+                                         [vehicle.latitude for vehicle in moving],
+                                         [vehicle.longitude for vehicle in moving])
+    # We know we're not at the stop, the StripConfig works out which loading light each one is on
+    return MotionFrame.Build(strips, stopped, moving_rows, percentages,
+                             [vehicle.speed for vehicle in moving],
+                             [vehicle.timestamp for vehicle in moving],
+                             data.progress.segment_meters(progress_rows), reported)
+
+
+def compute_frame(data, vehicles_by_route, log=print):
+    # Vehicles exactly where the feed reported them
+    return compute_motion(data, vehicles_by_route, log).at(None)
+
+
+def paint(framebuffer, frame: dict, colors):
+    # frame is {strip id: LightStatus codes}, colors the palette() of the light colors
+    for idx, codes in frame.items():
+        framebuffer.set_strip(idx, colors[codes].tolist())
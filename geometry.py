@@ -0,0 +1,40 @@
+class Segment:
+    """The stop codes and coordinates of two consecutive configured stops."""
+    __slots__ = ('prev_code', 'code', 'prev_point', 'point')
+
+    def __init__(self, prev_stop, stop):
+        self.prev_code = int(prev_stop.code)
+        self.code = int(stop.code)
+        self.prev_point = (float(prev_stop.latitude), float(prev_stop.longitude))
+        self.point = (float(stop.latitude), float(stop.longitude))
+
+
+class SegmentCache:
+    def __init__(self):
+        self.segments = {}
+
+    def get(self, prev_code: int, code: int) -> Segment:
+        return self.segments.get((prev_code, code))
+
+    def __len__(self):
+        return len(self.segments)
+
+    @staticmethod
+    def Build(layout, stops_by_code: dict, previous=None):
+        # One segment for every (prev stop, stop) pair the layout can ask about, taken from previous where it has it
+        cache = SegmentCache()
+        for stop_leds in layout.stops.values():
+            if stop_leds.prev is None:
+                continue
+            key = (stop_leds.prev.code, stop_leds.code)
+            if key in cache.segments:
+                continue
+            if previous is not None and key in previous.segments:
+                cache.segments[key] = previous.segments[key]
+                continue
+            prev_stop = stops_by_code.get(stop_leds.prev.code)
+            stop = stops_by_code.get(stop_leds.code)
+            if prev_stop is None or stop is None:
+                continue
+            cache.segments[key] = Segment(prev_stop, stop)
+        return cache
@@ -0,0 +1,166 @@
+import sqlite3
+import threading
+import time
+from transit import Route, Trip, Stop
+
+# (table, column) pairs every lookup below relies on
+required_indexes = (
+    ('routes', 'route_id'),
+    ('routes', 'route_short_name'),
+    ('trips', 'trip_id'),
+    ('trips', 'route_id'),
+    ('stops', 'stop_id'),
+    ('stops', 'stop_code'),
+    ('route_stops', 'route_id'),
+    ('route_stops', 'stop_id'),
+    ('shapes', 'shape_id'),
+    ('trip_spans', 'trip_id'),
+)
+
+ROUTE_BY_ID = 'SELECT * FROM routes r WHERE r.route_id = ?'
+ROUTE_BY_NAME = 'SELECT * FROM routes r WHERE r.route_short_name = ?'
+TRIP_BY_ID = 'SELECT * FROM trips t WHERE t.trip_id = ?'
+TRIPS_BY_ROUTE_IDS = 'SELECT * FROM trips t WHERE t.route_id IN ({})'
+STOPS_BY_ROUTE_ID = ('SELECT s.* FROM routes r JOIN route_stops rs ON rs.route_id = r.route_id '
+                     'JOIN stops s ON rs.stop_id = s.stop_id WHERE r.route_id = ?')
+STOP_BY_CODE = 'SELECT * FROM stops s WHERE s.stop_code = ?'
+SHAPE_POINTS = ('SELECT sh.shape_pt_lat, sh.shape_pt_lon, sh.shape_dist_traveled FROM shapes sh '
+                'WHERE sh.shape_id = ? ORDER BY sh.shape_pt_sequence')
+SERVICE_SPANS = ('SELECT t.service_id, MIN(ts.start_time) AS start_time, MAX(ts.end_time) AS end_time FROM trips t '
+                 'JOIN trip_spans ts ON ts.trip_id = t.trip_id WHERE t.route_id IN ({}) GROUP BY t.service_id')
+CALENDAR = 'SELECT * FROM calendar'
+CALENDAR_DATES = 'SELECT * FROM calendar_dates'
+AGENCY_TIMEZONE = "SELECT a.agency_timezone FROM agency a WHERE a.agency_timezone <> '' LIMIT 1"
+
+
+def dict_factory(cursor, row):
+    # Plain dicts are all the model classes need, they read rows with .get()
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class QueryTiming:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+class GtfsDatabase:
+    """
+    Parameterized access to gtfs_db. Statements are constant strings so sqlite3's
+    statement cache compiles each one once, rows come back as dicts and every
+    query's latency is recorded under its name.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Opened on the main thread, then used by the feed producer thread
+        self.conn = sqlite3.connect(path, check_same_thread=False, cached_statements=64)
+        self.conn.row_factory = dict_factory
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def close(self):
+        self.conn.close()
+
+    def has_table(self, table: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+    def ensure_indexes(self):
+        # Creates whatever required index is missing and returns the ones it had to create.
+        # Optional tables (shapes) that weren't ingested are skipped.
+        tables = {table for table, _ in required_indexes if self.has_table(table)}
+        indexed = set()
+        for table in tables:
+            for index in self.conn.execute('PRAGMA index_list({})'.format(table)).fetchall():
+                first_column = self.conn.execute('PRAGMA index_info({})'.format(index['name'])).fetchone()
+                if first_column is not None:
+                    indexed.add((table, first_column['name']))
+        missing = [pair for pair in required_indexes if pair[0] in tables and pair not in indexed]
+        for table, column in missing:
+            print('gtfs_db is missing an index on {}.{}, creating it'.format(table, column))
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_{0}_{1} ON {0} ({1})'.format(table, column))
+        self.conn.commit()
+        return missing
+
+    def query(self, name: str, sql: str, params=()):
+        start_time = time.perf_counter()
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = QueryTiming()
+        timing.record(time.perf_counter() - start_time)
+        return rows
+
+    def query_one(self, name: str, sql: str, params=()):
+        rows = self.query(name, sql, params)
+        return rows[0] if rows else None
+
+    def get_route_by_id(self, route_id):
+        row = self.query_one('route_by_id', ROUTE_BY_ID, (route_id,))
+        return None if row is None else Route(row)
+
+    def get_route_by_name(self, name):
+        row = self.query_one('route_by_name', ROUTE_BY_NAME, (name,))
+        return None if row is None else Route(row)
+
+    def get_trip_by_id(self, trip_id):
+        row = self.query_one('trip_by_id', TRIP_BY_ID, (trip_id,))
+        return None if row is None else Trip(row)
+
+    def get_trips_by_route_ids(self, route_ids):
+        route_ids = list(route_ids)
+        if not route_ids:
+            return []
+        sql = TRIPS_BY_ROUTE_IDS.format(','.join('?' for _ in route_ids))
+        return [Trip(row) for row in self.query('trips_by_route_ids', sql, route_ids)]
+
+    def get_stops_by_route_id(self, route_id):
+        return [Stop(row) for row in self.query('stops_by_route_id', STOPS_BY_ROUTE_ID, (route_id,))]
+
+    def get_stop_by_code(self, stop_code):
+        row = self.query_one('stop_by_code', STOP_BY_CODE, (stop_code,))
+        return None if row is None else Stop(row)
+
+    def get_shape_points(self, shape_id):
+        return self.query('shape_points', SHAPE_POINTS, (shape_id,))
+
+    def get_service_spans(self, route_ids):
+        # {service_id: (first departure, last arrival)} over the routes' trips, empty if trip_spans wasn't ingested
+        route_ids = list(route_ids)
+        if not route_ids or not self.has_table('trip_spans'):
+            return {}
+        sql = SERVICE_SPANS.format(','.join('?' for _ in route_ids))
+        return {row['service_id']: (row['start_time'], row['end_time'])
+                for row in self.query('service_spans', sql, route_ids)
+                if row['start_time'] is not None and row['end_time'] is not None}
+
+    def get_calendar(self):
+        return self.query('calendar', CALENDAR) if self.has_table('calendar') else []
+
+    def get_calendar_dates(self):
+        return self.query('calendar_dates', CALENDAR_DATES) if self.has_table('calendar_dates') else []
+
+    def get_agency_timezone(self):
+        # GTFS requires every agency in a feed to share one timezone, None if agency wasn't ingested
+        row = self.query_one('agency_timezone', AGENCY_TIMEZONE) if self.has_table('agency') else None
+        return None if row is None else row['agency_timezone']
+
+    def query_stats(self):
+        return {
+            name: {
+                'count': timing.count,
+                'avg_ms': timing.total / timing.count * 1000,
+                'max_ms': timing.max * 1000,
+            }
+            for name, timing in self.timings.items()
+        }
@@ -0,0 +1,198 @@
+"""
+Builds the gtfs_db SQLite database app.py reads from a GTFS static zip.
+
+    python ingest.py gtfs.db                       # download static_url
+    python ingest.py gtfs.db --zip google_transit.zip
+
+Every member is streamed in chunks with explicit dtypes, so peak memory does
+not depend on the size of stop_times.txt.
+"""
+import argparse
+import csv
+import io
+import os
+import sqlite3
+import time
+import zipfile
+import numpy as np
+import pandas as pd
+from transit import TransitFeed, print_stopwatch
+from gtfs_db import required_indexes
+from timetable import MISSING, parse_gtfs_times
+
+static_url = 'https://metro.kingcounty.gov/GTFS/google_transit.zip'
+chunk_size = 50000
+
+# SQLite column types for the GTFS columns we know about. Integer affinity still
+# stores non-numeric ids as text, so this is safe for agencies with string ids.
+column_types = {
+    'route_id': 'INTEGER',
+    'agency_id': 'TEXT',
+    'agency_timezone': 'TEXT',
+    'route_short_name': 'TEXT',
+    'route_type': 'INTEGER',
+    'trip_id': 'INTEGER',
+    'service_id': 'INTEGER',
+    'direction_id': 'INTEGER',
+    'block_id': 'INTEGER',
+    'shape_id': 'INTEGER',
+    'stop_id': 'INTEGER',
+    'stop_code': 'INTEGER',
+    'stop_lat': 'REAL',
+    'stop_lon': 'REAL',
+    'location_type': 'INTEGER',
+    'wheelchair_boarding': 'INTEGER',
+    'wheelchair_accessible': 'INTEGER',
+    'bikes_allowed': 'INTEGER',
+    'stop_sequence': 'INTEGER',
+    'shape_dist_traveled': 'REAL',
+    'shape_pt_lat': 'REAL',
+    'shape_pt_lon': 'REAL',
+    'shape_pt_sequence': 'INTEGER',
+    'start_time': 'INTEGER',
+    'end_time': 'INTEGER',
+    'monday': 'INTEGER',
+    'tuesday': 'INTEGER',
+    'wednesday': 'INTEGER',
+    'thursday': 'INTEGER',
+    'friday': 'INTEGER',
+    'saturday': 'INTEGER',
+    'sunday': 'INTEGER',
+    'exception_type': 'INTEGER',
+}
+
+float_columns = {'stop_lat', 'stop_lon', 'shape_dist_traveled', 'shape_pt_lat', 'shape_pt_lon'}
+
+
+def read_header(archive: zipfile.ZipFile, member: str):
+    with archive.open(member) as raw:
+        return next(csv.reader(io.TextIOWrapper(raw, encoding='utf-8-sig')))
+
+
+def read_chunks(archive: zipfile.ZipFile, member: str, columns, usecols=None):
+    dtypes = {column: ('float64' if column in float_columns else 'str') for column in columns}
+    with archive.open(member) as raw:
+        reader = pd.read_csv(raw, dtype=dtypes, usecols=usecols, chunksize=chunk_size,
+                             encoding='utf-8-sig', keep_default_na=False, na_values=[''])
+        for chunk in reader:
+            # NaN -> NULL
+            yield chunk.astype(object).where(chunk.notna(), None)
+
+
+def create_table(conn, table: str, columns):
+    conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+    definitions = ', '.join('{} {}'.format(column, column_types.get(column, 'TEXT')) for column in columns)
+    conn.execute('CREATE TABLE {} ({})'.format(table, definitions))
+
+
+def insert_rows(conn, table: str, columns, rows):
+    placeholders = ', '.join('?' for _ in columns)
+    conn.executemany('INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(columns), placeholders), rows)
+
+
+def load_member(conn, archive: zipfile.ZipFile, table: str):
+    columns = read_header(archive, table + '.txt')
+    create_table(conn, table, columns)
+    count = 0
+    for chunk in read_chunks(archive, table + '.txt', columns):
+        insert_rows(conn, table, columns, chunk.itertuples(index=False, name=None))
+        count += len(chunk)
+    return count
+
+
+def load_route_stops(conn, archive: zipfile.ZipFile):
+    # Only the trip -> route map, the distinct pairs and each trip's first and last
+    # time are kept, never stop_times itself
+    route_by_trip = dict(conn.execute('SELECT trip_id, route_id FROM trips'))
+    pairs = set()
+    spans = []
+    columns = ['trip_id', 'stop_id', 'arrival_time', 'departure_time']
+    for chunk in read_chunks(archive, 'stop_times.txt', columns, usecols=columns):
+        for trip_id, stop_id in chunk[['trip_id', 'stop_id']].itertuples(index=False, name=None):
+            route_id = route_by_trip.get(int(trip_id) if trip_id.isdigit() else trip_id)
+            if route_id is not None:
+                pairs.add((route_id, stop_id))
+        times = pd.DataFrame({
+            'trip_id': chunk['trip_id'],
+            'start_time': parse_gtfs_times(chunk['departure_time']),
+            'end_time': parse_gtfs_times(chunk['arrival_time']),
+        }).replace(MISSING, np.nan)
+        spans.append(times.groupby('trip_id').agg({'start_time': 'min', 'end_time': 'max'}))
+    create_table(conn, 'route_stops', ['route_id', 'stop_id'])
+    insert_rows(conn, 'route_stops', ['route_id', 'stop_id'], sorted(pairs, key=str))
+
+    # Service hours for the poll scheduler, in seconds after midnight of the service day.
+    # A trip can straddle two chunks, so the per-chunk spans are combined once more.
+    create_table(conn, 'trip_spans', ['trip_id', 'start_time', 'end_time'])
+    if spans:
+        trip_spans = pd.concat(spans).groupby(level=0).agg({'start_time': 'min', 'end_time': 'max'})
+        trip_spans = trip_spans.astype(object).where(trip_spans.notna(), None)
+        insert_rows(conn, 'trip_spans', ['trip_id', 'start_time', 'end_time'],
+                    ((trip_id, None if start_time is None else int(start_time), None if end_time is None else int(end_time))
+                     for trip_id, start_time, end_time in trip_spans.itertuples(name=None)))
+    return len(pairs)
+
+
+def create_indexes(conn):
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table, column in required_indexes:
+        if table not in tables:
+            continue
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_{0}_{1} ON {0} ({1})'.format(table, column))
+
+
+def build_database(archive: zipfile.ZipFile, db_path: str):
+    conn = sqlite3.connect(db_path)
+    # Throwaway build, durability only matters once it's committed
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    report = []
+    try:
+        for table in ('routes', 'trips', 'stops'):
+            start_time = time.time()
+            count = load_member(conn, archive, table)
+            report.append((table, count, time.time() - start_time))
+
+        start_time = time.time()
+        count = load_route_stops(conn, archive)
+        report.append(('route_stops', count, time.time() - start_time))
+
+        # Optional in GTFS: shapes for shape-aware progress, the calendars for service hours.
+        # agency is required, but only its timezone is used and older databases lack it too.
+        for table in ('agency', 'shapes', 'calendar', 'calendar_dates'):
+            if table + '.txt' not in archive.namelist():
+                continue
+            start_time = time.time()
+            count = load_member(conn, archive, table)
+            report.append((table, count, time.time() - start_time))
+
+        start_time = time.time()
+        create_indexes(conn)
+        report.append(('indexes', None, time.time() - start_time))
+        conn.commit()
+    finally:
+        conn.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('db', help='SQLite database to (re)build')
+    parser.add_argument('--zip', help='Local GTFS zip, downloaded from static_url if omitted')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    zip_path = args.zip
+    if zip_path is None:
+        zip_path = TransitFeed(static_url, None, None).DownloadStaticFeed(os.path.splitext(args.db)[0] + '.zip')
+        print_stopwatch(time.time() - start_time, 'Downloaded {}'.format(zip_path))
+
+    with zipfile.ZipFile(zip_path) as archive:
+        report = build_database(archive, args.db)
+    for table, count, seconds in report:
+        print_stopwatch(seconds, table if count is None else '{} ({} rows)'.format(table, count))
+    print_stopwatch(time.time() - start_time, 'Total')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+from strip_config import BoundingArea
+
+
+class LayoutError(ValueError):
+    pass
+
+
+def parse_led_address(led_code: str) -> tuple:
+    # "strip:led" -> (strip, led)
+    try:
+        strip_index, led_index = led_code.split(':')
+        return (int(strip_index), int(led_index))
+    except (AttributeError, ValueError):
+        raise LayoutError('Invalid LED address {!r}, expected "strip:led"'.format(led_code))
+
+
+class StopLeds(NamedTuple):
+    route_short_name: str
+    direction: int
+    code: int
+    led: tuple
+    prev: Optional['StopLeds']
+    thresholds: tuple
+    loading_leds: tuple
+    area: Optional[BoundingArea]
+
+
+class LedLayout:
+    """Immutable, pre-indexed form of strips.json. Build it with compile_layout()."""
+    __slots__ = ('stops', 'stations')
+
+    def __init__(self, stops: dict, stations: dict):
+        self.stops = MappingProxyType(stops)
+        self.stations = MappingProxyType(stations)
+
+    def __reduce__(self):
+        # mappingproxy can't be pickled, rebuild it from plain dicts
+        return (LedLayout, (dict(self.stops), dict(self.stations)))
+
+    def route_stations(self, route_short_name: str) -> tuple:
+        return self.stations.get(route_short_name, ())
+
+    def route_names(self):
+        return self.stations.keys()
+
+
+def compile_layout(led_config: dict, strip_lengths: dict, stops_by_code: dict = None, stop_radius: float = 0.002,
+                   previous: LedLayout = None, unchanged=()) -> LedLayout:
+    """
+    Compiles the strips.json structure into a LedLayout, raising LayoutError for
+    malformed entries, LEDs outside the configured strips and LEDs used twice.
+    When stops_by_code is given, each stop also gets its BoundingArea.
+    A loading LED's percentage is the upper bound of the progress towards its
+    stop (0 at the previous stop, 1 at this one) that it shows.
+    Routes named in unchanged keep their compiled stops from previous, only their
+    LEDs are checked against the rest again.
+    """
+    owners = {}
+    previous_stops = {}
+    if previous is not None:
+        for stop in previous.stops.values():
+            if stop.route_short_name in unchanged:
+                previous_stops.setdefault(stop.route_short_name, []).append(stop)
+
+    def claim(led_code, owner):
+        return claim_address(parse_led_address(led_code), led_code, owner)
+
+    def claim_address(address, led_code, owner):
+        strip_index, led_index = address
+        length = strip_lengths.get(strip_index)
+        if length is None:
+            raise LayoutError('{} uses LED {} on unknown strip {}'.format(owner, led_code, strip_index))
+        if not 0 <= led_index < length:
+            raise LayoutError('{} uses LED {} outside strip {} (length {})'.format(owner, led_code, strip_index, length))
+        previous_owner = owners.setdefault(address, owner)
+        if previous_owner != owner:
+            raise LayoutError('LED {} is used by both {} and {}'.format(led_code, previous_owner, owner))
+        return address
+
+    stops = {}
+    stations = {}
+    for route_short_name, line_directions in led_config.items():
+        if route_short_name in previous_stops:
+            for stop in previous_stops[route_short_name]:
+                claim_address(stop.led, '{}:{}'.format(*stop.led), 'stop {}'.format(stop.code))
+                for led in stop.loading_leds:
+                    claim_address(led, '{}:{}'.format(*led), '{} direction {} approach to {}'.format(route_short_name, stop.direction, stop.code))
+                stops[(route_short_name, stop.direction, stop.code)] = stop
+            stations[route_short_name] = previous.route_stations(route_short_name)
+            continue
+        route_stations = []
+        for directional_config in line_directions:
+            direction = int(directional_config.get('direction'))
+            prev = None
+            for item in directional_config.get('stops', []):
+                try:
+                    code = int(item['code'])
+                except (KeyError, TypeError, ValueError):
+                    raise LayoutError('{} direction {} has a stop without a valid code: {!r}'.format(route_short_name, direction, item))
+                key = (route_short_name, direction, code)
+                if key in stops:
+                    raise LayoutError('Stop {} appears twice in {} direction {}'.format(code, route_short_name, direction))
+                led = claim(item.get('led'), 'stop {}'.format(code))
+
+                loading = sorted(item.get('loading', []), key=lambda obj: float(obj.get('percentage')))
+                thresholds = tuple(float(obj.get('percentage')) for obj in loading)
+                if len(set(thresholds)) != len(thresholds):
+                    raise LayoutError('Stop {} in {} has duplicate loading percentages'.format(code, route_short_name))
+                loading_leds = tuple(
+                    claim(obj.get('led'), '{} direction {} approach to {}'.format(route_short_name, direction, code))
+                    for obj in loading)
+
+                area = None
+                if stops_by_code is not None:
+                    stop = stops_by_code.get(code)
+                    if stop is None:
+                        raise LayoutError('Stop {} in {} is not served by the route'.format(code, route_short_name))
+                    area = BoundingArea.FromPoint(stop.latitude, stop.longitude, stop_radius)
+
+                prev = StopLeds(route_short_name, direction, code, led, prev, thresholds, loading_leds, area)
+                stops[key] = prev
+                route_stations.append(led)
+        stations[route_short_name] = tuple(dict.fromkeys(route_stations))
+    return LedLayout(stops, stations)
@@ -0,0 +1,272 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from a fraction of a millisecond (parse, paint) up to a slow fetch
+default_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+prefix = 'ledmap'
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        histogram.max = self.max
+        return histogram
+
+    def quantile(self, fraction: float) -> float:
+        # Upper bound of the bucket the quantile falls in, good enough to see which stage is slow
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _StageTimer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class Metrics:
+    """
+    Per-stage latency histograms and counters for the fetch/compute/render cycle.
+
+    Disabled by default: time() hands back a shared no-op context manager and
+    observe()/count() return straight away, so the hot path pays for one
+    attribute check. Components that already keep their own numbers (fetcher,
+    pipeline, output, gtfs_db) are added with register() and read on export,
+    stage histograms recorded elsewhere (the decode worker's) with register_stages().
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.collectors = {}
+        self.stage_sources = {}
+        self.started = time.time()
+
+    def time(self, stage: str):
+        if not self.enabled:
+            return _null_timer
+        return _StageTimer(self, stage)
+
+    def observe(self, stage: str, seconds: float):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name: str, value: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def register(self, name: str, collector):
+        # collector() returns a flat dict of numbers, or a dict of those keyed by label (e.g. bus or query name)
+        self.collectors[name] = collector
+
+    def register_stages(self, name: str, source):
+        # source() returns {stage: Histogram}, exported as name_stage next to the own stages
+        self.stage_sources[name] = source
+
+    def histograms(self) -> dict:
+        with self.lock:
+            histograms = {stage: histogram.copy() for stage, histogram in self.stages.items()}
+        for name, source in list(self.stage_sources.items()):
+            try:
+                for stage, histogram in source().items():
+                    histograms['{}_{}'.format(name, stage)] = histogram
+            except Exception as e:
+                print('Could not read {} stages: {}'.format(name, e))
+        return histograms
+
+    def collect(self):
+        collected = {}
+        for name, collector in list(self.collectors.items()):
+            try:
+                collected[name] = collector()
+            except Exception as e:
+                collected[name] = {'error': str(e)}
+        return collected
+
+    def snapshot(self):
+        stages = {
+            stage: {
+                'count': histogram.count,
+                'avg_ms': histogram.sum / histogram.count * 1000 if histogram.count else 0,
+                'p50_ms': histogram.quantile(0.5) * 1000,
+                'p95_ms': histogram.quantile(0.95) * 1000,
+                'p99_ms': histogram.quantile(0.99) * 1000,
+                'max_ms': histogram.max * 1000,
+            }
+            for stage, histogram in self.histograms().items()
+        }
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            'uptime': time.time() - self.started,
+            'stages': stages,
+            'counters': counters,
+            'components': self.collect(),
+        }
+
+    def prometheus(self) -> str:
+        lines = []
+        stages = [(stage, histogram.counts, histogram.count, histogram.sum, histogram.buckets)
+                  for stage, histogram in self.histograms().items()]
+        with self.lock:
+            counters = list(self.counters.items())
+
+        name = '{}_stage_seconds'.format(prefix)
+        lines.append('# TYPE {} histogram'.format(name))
+        for stage, counts, count, total, buckets in stages:
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, cumulative))
+            lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(name, stage, count))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, total))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, count))
+
+        for counter, value in counters:
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, counter))
+            lines.append('{}_{}_total {}'.format(prefix, counter, value))
+
+        for component, values in self.collect().items():
+            for key, value in values.items():
+                if isinstance(value, dict):
+                    # Labelled component, e.g. {'SPI': {'pushes': 3}} from the output driver
+                    for field, field_value in value.items():
+                        if isinstance(field_value, (int, float)):
+                            lines.append('{}_{}_{}{{name="{}"}} {}'.format(prefix, component, field, key, field_value))
+                elif isinstance(value, (int, float)):
+                    lines.append('{}_{}_{} {}'.format(prefix, component, key, value))
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry, switched on by app.py when an endpoint or dump file is configured
+metrics = Metrics()
+
+
+class MetricsServer:
+    """Serves /metrics (Prometheus text) and /stats.json on a local port from a daemon thread."""
+
+    def __init__(self, registry: Metrics, port: int, host: str = '127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = registry.prometheus().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/stats.json':
+                    body = json.dumps(registry.snapshot()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class StatsDumper:
+    """Writes registry.snapshot() as JSON to path every interval seconds, replacing the file atomically."""
+
+    def __init__(self, registry: Metrics, path: str, interval: float = 60):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def dump(self):
+        partial_path = self.path + '.tmp'
+        with open(partial_path, 'w') as stats_file:
+            json.dump(self.registry.snapshot(), stats_file, indent=2)
+        os.replace(partial_path, self.path)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.dump()
+            except OSError as e:
+                print('Could not write stats to {}: {}'.format(self.path, e))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='stats-dump', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
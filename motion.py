@@ -0,0 +1,106 @@
+import numpy as np
+
+# Don't carry a vehicle forward on a stale report for longer than this many seconds
+max_extrapolation = 30
+# Extrapolated vehicles stop short of the next stop, arriving is for the feed to say
+max_progress = 0.99
+
+
+class MotionFrame:
+    """
+    A computed frame plus what's needed to move its vehicles between feed updates.
+
+    stopped holds the StripConfig row of every stop with a vehicle at it. Each
+    moving vehicle has the row of the stop it is heading to, its progress along
+    the segment when it was reported, the fraction of the segment it covers per
+    second (speed / segment length) and the time of the report. at(now) advances
+    all of them by dead reckoning in one array operation and has the StripConfig
+    the frame was computed against place them. reported is the header timestamp
+    of the feed the frame came from.
+    """
+
+    def __init__(self, strips, stopped=(), moving=(), progress=(), rates=(), timestamps=(), reported=0):
+        self.strips = strips
+        self.reported = reported
+        self.stopped = np.asarray(stopped, dtype=np.intp)
+        self.moving = np.asarray(moving, dtype=np.intp)
+        self.progress = np.asarray(progress, dtype=np.float64)
+        self.rates = np.asarray(rates, dtype=np.float64)
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.moving)
+
+    def advance(self, now=None):
+        # Progress of every moving vehicle at time now, or as reported when now is None
+        if now is None or not len(self.moving):
+            return self.progress
+        elapsed = np.clip(now - self.timestamps, 0, max_extrapolation)
+        advanced = np.minimum(self.progress + self.rates * elapsed, max_progress)
+        # Never move a vehicle backwards, e.g. one already reported past max_progress
+        return np.maximum(advanced, self.progress)
+
+    def age(self, now: float) -> float:
+        # Seconds since the feed was published, 0 when unknown
+        return max(now - self.reported, 0) if self.reported else 0.0
+
+    def at(self, now=None) -> dict:
+        # {strip id: LightStatus codes}, see StripConfig.calculate_strip
+        return self.strips.calculate_strip(self.stopped, self.moving, self.advance(now))
+
+    @staticmethod
+    def Build(strips, stopped, moving, progress, speeds, timestamps, segment_meters, reported=0):
+        """
+        Drops vehicles without a known progress. speeds are in meters per second,
+        segment_meters the length of each vehicle's segment. Missing speeds, lengths
+        or timestamps leave the vehicle where it was reported.
+        """
+        moving = np.asarray(moving, dtype=np.intp)
+        progress = np.asarray(progress, dtype=np.float64)
+        speeds = np.nan_to_num(np.asarray(speeds, dtype=np.float64), nan=0.0)
+        segment_meters = np.asarray(segment_meters, dtype=np.float64)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rates = np.where((speeds > 0) & (segment_meters > 0) & (timestamps > 0), speeds / segment_meters, 0.0)
+        keep = ~np.isnan(progress)
+        return MotionFrame(strips, stopped, moving[keep], progress[keep], rates[keep], timestamps[keep], reported)
+
+
+class Staleness:
+    """
+    Fades vehicles out as the feed they came from ages, for when polls keep
+    failing or the app starts from a cached feed. Up to fresh seconds they are
+    at full brightness, then they dim linearly down to floor at limit seconds.
+    palette(age) returns None past limit, when only the stations should be shown.
+    """
+
+    def __init__(self, colors, codes, fresh: float = 60, limit: float = 600, floor: float = 0.2, steps: int = 32):
+        self.colors = colors
+        # LightStatus codes of the LEDs that show vehicles
+        self.codes = list(codes)
+        self.fresh = fresh
+        self.limit = limit
+        self.floor = floor
+        self.steps = steps
+        self.palettes = {}
+
+    def brightness(self, age: float) -> float:
+        if age <= self.fresh:
+            return 1.0
+        faded = min((age - self.fresh) / max(self.limit - self.fresh, 1e-9), 1.0)
+        return 1.0 - faded * (1.0 - self.floor)
+
+    def palette(self, age: float):
+        if age > self.limit:
+            return None
+        # Brightness is quantized so the few palettes in use are built once
+        step = round(self.brightness(age) * self.steps)
+        colors = self.palettes.get(step)
+        if colors is None:
+            colors = self.colors.copy()
+            shifts = np.array([16, 8, 0], dtype=np.uint32)
+            channels = (colors[self.codes, None] >> shifts) & 0xFF
+            channels = (channels * (step / self.steps)).astype(np.uint32)
+            colors[self.codes] = (channels << shifts).sum(axis=1, dtype=np.uint32)
+            self.palettes[step] = colors
+        return colors
@@ -0,0 +1,117 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PushTiming:
+    __slots__ = ('count', 'total', 'max', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+def open_bus(name: str):
+    # "SPI" is the board's default bus, anything else is "CLOCK/MOSI" pin names, e.g. "SCK_1/MOSI_1"
+    import board
+    if name == 'SPI':
+        return board.SPI()
+    import busio
+    clock, mosi = name.split('/')
+    return busio.SPI(getattr(board, clock), MOSI=getattr(board, mosi))
+
+
+def create_strip(bus, config: dict):
+    import neopixel_spi
+    pixel_order = getattr(neopixel_spi, config.get('pixel_order', 'GRB'))
+    return neopixel_spi.NeoPixel_SPI(bus, config['length'], brightness=config.get('brightness', 0.1),
+                                     pixel_order=pixel_order, auto_write=False)
+
+
+class MemoryStrip(list):
+    """Stands in for a NeoPixel_SPI strip when there is no hardware, counting show() calls."""
+
+    def __init__(self, length: int):
+        super().__init__([0] * length)
+        self.shows = 0
+
+    def fill(self, color: int):
+        self[:] = [color] * len(self)
+
+    def show(self):
+        self.shows += 1
+
+
+class OutputDriver:
+    """
+    Owns the physical strips. Strips sharing an SPI bus are written one after the
+    other, independent buses are flushed concurrently from a small thread pool,
+    and the time to push each bus is recorded.
+    """
+
+    def __init__(self, strips: dict, buses: dict):
+        self.strips = strips
+        self.buses = buses
+        self.timings = {bus: PushTiming() for bus in buses}
+        self.executor = ThreadPoolExecutor(max_workers=len(buses), thread_name_prefix='spi') if len(buses) > 1 else None
+
+    def lengths(self):
+        return {idx: len(strip) for idx, strip in self.strips.items()}
+
+    def push_bus(self, bus: str, framebuffer, dirty):
+        start_time = time.perf_counter()
+        for idx in self.buses[bus]:
+            if idx in dirty:
+                framebuffer.flush_strip(idx, self.strips[idx])
+        self.timings[bus].record(time.perf_counter() - start_time)
+
+    def push(self, framebuffer):
+        dirty = set(framebuffer.dirty())
+        buses = [bus for bus, strip_ids in self.buses.items() if dirty.intersection(strip_ids)]
+        if self.executor is None or len(buses) < 2:
+            for bus in buses:
+                self.push_bus(bus, framebuffer, dirty)
+        else:
+            for future in [self.executor.submit(self.push_bus, bus, framebuffer, dirty) for bus in buses]:
+                future.result()
+        return dirty
+
+    def stats(self):
+        return {
+            bus: {
+                'pushes': timing.count,
+                'last_ms': timing.last * 1000,
+                'avg_ms': timing.total / timing.count * 1000 if timing.count else 0,
+                'max_ms': timing.max * 1000,
+            }
+            for bus, timing in self.timings.items()
+        }
+
+    @staticmethod
+    def InMemory(strip_lengths: dict):
+        strips = {idx: MemoryStrip(length) for idx, length in strip_lengths.items()}
+        return OutputDriver(strips, {'memory': list(strips)})
+
+    @staticmethod
+    def FromConfig(output_config: dict):
+        strips = {}
+        buses = {}
+        opened = {}
+        for strip_config in output_config.get('strips', []):
+            idx = int(strip_config['id'])
+            if idx in strips:
+                raise ValueError('Strip {} is configured twice'.format(idx))
+            bus_name = strip_config.get('bus', 'SPI')
+            if bus_name not in opened:
+                opened[bus_name] = open_bus(bus_name)
+            strips[idx] = create_strip(opened[bus_name], strip_config)
+            buses.setdefault(bus_name, []).append(idx)
+        return OutputDriver(strips, buses)
@@ -0,0 +1,131 @@
+import asyncio
+
+
+def put_latest(queue: asyncio.Queue, item) -> int:
+    # Make room by dropping whatever is still waiting, consumers only want the newest item
+    dropped = 0
+    while True:
+        try:
+            queue.put_nowait(item)
+            return dropped
+        except asyncio.QueueFull:
+            try:
+                queue.get_nowait()
+                dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+
+
+class Pipeline:
+    """
+    Runs fetch, compute and render as three asyncio tasks joined by bounded queues.
+
+    produce() is blocking (network + decode) and runs in a worker thread every
+    poll_interval seconds, returning a snapshot or None when there is nothing new.
+    compute(snapshot) turns a snapshot into a frame, and render(frame) pushes it to
+    the strips on a fixed frame_interval tick. Both schedules are held to their
+    target period rather than sleeping a fixed time after the work is done.
+    With animate, the latest frame is rendered again on every tick, so render()
+    can move vehicles along between snapshots, starting with initial if given.
+
+    replace_frame() swaps the frame being rendered from another thread, e.g.
+    after the layout changed, without waiting for the next snapshot.
+
+    Given a scheduler, its after_poll() decides the wait before each poll instead
+    of poll_interval, and a failing produce() is logged and backed off rather
+    than ending the pipeline.
+    """
+
+    def __init__(self, produce, compute, render, poll_interval: float = 8, frame_interval: float = 0.5, queue_size: int = 1,
+                 animate: bool = False, scheduler=None, initial=None):
+        self.produce = produce
+        self.compute = compute
+        self.render = render
+        self.poll_interval = poll_interval
+        self.frame_interval = frame_interval
+        self.queue_size = queue_size
+        self.animate = animate
+        self.scheduler = scheduler
+        self.initial = initial
+        self.replacement = None
+        self.failed_polls = 0
+        self.snapshots = None
+        self.frames = None
+        self.dropped_snapshots = 0
+        self.dropped_frames = 0
+        self.rendered_frames = 0
+
+    @staticmethod
+    async def sleep_until(loop, deadline: float) -> float:
+        # If we fell behind, start the schedule over from now instead of bursting to catch up
+        delay = deadline - loop.time()
+        if delay < 0:
+            deadline = loop.time()
+            delay = 0
+        await asyncio.sleep(delay)
+        return deadline
+
+    async def producer(self):
+        if self.scheduler is not None:
+            return await self.scheduled_producer()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            snapshot = await asyncio.to_thread(self.produce)
+            if snapshot is not None:
+                self.dropped_snapshots += put_latest(self.snapshots, snapshot)
+            deadline = await self.sleep_until(loop, deadline + self.poll_interval)
+
+    async def scheduled_producer(self):
+        while True:
+            failed = False
+            snapshot = None
+            try:
+                snapshot = await asyncio.to_thread(self.produce)
+            except Exception as e:
+                failed = True
+                self.failed_polls += 1
+                print('Feed poll failed: {}'.format(e))
+            if snapshot is not None:
+                self.dropped_snapshots += put_latest(self.snapshots, snapshot)
+            await asyncio.sleep(self.scheduler.after_poll(snapshot is not None, failed))
+
+    async def computer(self):
+        while True:
+            snapshot = await self.snapshots.get()
+            frame = await asyncio.to_thread(self.compute, snapshot)
+            self.dropped_frames += put_latest(self.frames, frame)
+
+    async def renderer(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        current = self.initial
+        while True:
+            try:
+                frame = self.frames.get_nowait()
+                current = frame
+            except asyncio.QueueEmpty:
+                frame = current if self.animate else None
+            replacement, self.replacement = self.replacement, None
+            if replacement is not None:
+                frame = current = replacement
+            if frame is not None:
+                self.render(frame)
+                self.rendered_frames += 1
+            deadline = await self.sleep_until(loop, deadline + self.frame_interval)
+
+    def replace_frame(self, frame):
+        self.replacement = frame
+
+    async def run(self):
+        self.snapshots = asyncio.Queue(self.queue_size)
+        self.frames = asyncio.Queue(self.queue_size)
+        await asyncio.gather(self.producer(), self.computer(), self.renderer())
+
+    def stats(self):
+        return {
+            'dropped_snapshots': self.dropped_snapshots,
+            'dropped_frames': self.dropped_frames,
+            'rendered_frames': self.rendered_frames,
+            'failed_polls': self.failed_polls,
+        }
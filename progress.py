@@ -0,0 +1,170 @@
+import math
+import numpy as np
+
+# How far (in degrees of latitude) a stop may sit from a shape and still be considered on it
+stop_tolerance = 0.001
+meters_per_degree = 111320
+
+
+def planar(latitudes, longitudes, cos_lat: float):
+    # Equirectangular projection, plenty accurate over the span of a segment
+    return np.stack([np.asarray(longitudes, dtype=np.float64) * cos_lat,
+                     np.asarray(latitudes, dtype=np.float64)], axis=-1)
+
+
+def project(points, starts, ends, cum_starts, cum_ends, valid):
+    """
+    Projects points (V, 2) onto polylines given as padded edge arrays (V, E, 2).
+    Returns the distance along each polyline (in cum units) and the squared
+    distance from each point to its polyline.
+    """
+    edges = ends - starts
+    offsets = points[:, None, :] - starts
+    lengths = np.einsum('veu,veu->ve', edges, edges)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(lengths > 0, np.einsum('veu,veu->ve', offsets, edges) / lengths, 0)
+    t = np.clip(t, 0, 1)
+    nearest = starts + t[..., None] * edges
+    error = np.einsum('veu,veu->ve', points[:, None, :] - nearest, points[:, None, :] - nearest)
+    error = np.where(valid, error, np.inf)
+    best = np.argmin(error, axis=1)
+    rows = np.arange(len(points))
+    along = cum_starts[rows, best] + t[rows, best] * (cum_ends[rows, best] - cum_starts[rows, best])
+    return along, error[rows, best]
+
+
+class ProgressEngine:
+    """
+    Polylines for every configured (prev stop, stop) segment, cut out of the GTFS
+    shapes the configured routes' trips follow. progress() projects a whole batch
+    of vehicles onto their segments at once and returns how far along each one is,
+    0 at the previous stop and 1 at the next.
+
+    Segments are keyed by (shape_id, prev_code, code). Vehicles whose trip has no
+    known shape use a straight line between the two stops, keyed with shape_id None.
+    """
+
+    def __init__(self, polylines: dict, cos_lat: float, shape_pairs=None, pairs=()):
+        self.cos_lat = cos_lat
+        # Kept for Build(previous=...): the polylines, which (prev_code, code) pairs every shape was cut
+        # against, and all the pairs
+        self.polylines = polylines
+        self.shape_pairs = {shape_id: frozenset(cut) for shape_id, cut in (shape_pairs or {}).items()}
+        self.pairs = frozenset(pairs)
+        self.keys = {key: row for row, key in enumerate(polylines)}
+        edge_count = max([len(cum) - 1 for _, cum in polylines.values()] + [1])
+        self.starts = np.zeros((len(polylines), edge_count, 2))
+        self.ends = np.zeros((len(polylines), edge_count, 2))
+        self.cum_starts = np.zeros((len(polylines), edge_count))
+        self.cum_ends = np.zeros((len(polylines), edge_count))
+        self.valid = np.zeros((len(polylines), edge_count), dtype=bool)
+        self.lengths = np.ones(len(polylines))
+        # Real length of every polyline, shape_dist_traveled units vary by agency
+        self.meters = np.zeros(len(polylines))
+        for row, (points, cum) in enumerate(polylines.values()):
+            edges = len(cum) - 1
+            self.starts[row, :edges] = points[:-1]
+            self.ends[row, :edges] = points[1:]
+            self.cum_starts[row, :edges] = cum[:-1]
+            self.cum_ends[row, :edges] = cum[1:]
+            self.valid[row, :edges] = True
+            self.lengths[row] = cum[-1] if cum[-1] > 0 else 1
+            self.meters[row] = np.hypot(*np.diff(points, axis=0).T).sum() * meters_per_degree
+
+    def __len__(self):
+        return len(self.keys)
+
+    def row(self, shape_id, prev_code: int, code: int) -> int:
+        row = self.keys.get((shape_id, prev_code, code))
+        if row is None:
+            row = self.keys.get((None, prev_code, code), -1)
+        return row
+
+    def progress(self, rows, latitudes, longitudes):
+        rows = np.asarray(rows, dtype=np.intp)
+        result = np.full(len(rows), np.nan)
+        known = rows >= 0
+        if not known.any():
+            return result
+        rows = rows[known]
+        points = planar(np.asarray(latitudes)[known], np.asarray(longitudes)[known], self.cos_lat)
+        along, _ = project(points, self.starts[rows], self.ends[rows], self.cum_starts[rows], self.cum_ends[rows], self.valid[rows])
+        result[known] = np.clip(along / self.lengths[rows], 0, 1)
+        return result
+
+    def segment_meters(self, rows):
+        # Length in meters of each row's segment, NaN for unknown rows
+        rows = np.asarray(rows, dtype=np.intp)
+        result = np.full(len(rows), np.nan)
+        known = rows >= 0
+        result[known] = self.meters[rows[known]]
+        return result
+
+    @staticmethod
+    def Build(db, segments, shape_pairs: dict, previous=None):
+        """
+        segments is the SegmentCache with the stop coordinates of every configured
+        pair, shape_pairs maps the shapes of the configured routes' trips to the
+        (prev_code, code) pairs of the routes using them; a shape is only cut
+        against those. With previous, shapes are only loaded and cut for the pairs
+        previous didn't cut them against, the rest of its polylines are reused
+        (along with its projection).
+        """
+        pairs = list(segments.segments.values())
+        if not pairs:
+            return ProgressEngine({}, 1.0)
+        if previous is not None and previous.pairs:
+            cos_lat = previous.cos_lat
+        else:
+            previous = None
+            cos_lat = math.cos(math.radians(sum(segment.point[0] for segment in pairs) / len(pairs)))
+        polylines = {}
+        for segment in pairs:
+            ends = planar([segment.prev_point[0], segment.point[0]], [segment.prev_point[1], segment.point[1]], cos_lat)
+            polylines[(None, segment.prev_code, segment.code)] = (ends, np.array([0, np.hypot(*(ends[1] - ends[0]))]))
+
+        cut_pairs = {}
+        if db.has_table('shapes'):
+            for shape_id, wanted in shape_pairs.items():
+                shape_segments = [segments.segments[pair] for pair in wanted if pair in segments.segments]
+                cut_pairs[shape_id] = [(segment.prev_code, segment.code) for segment in shape_segments]
+                if previous is not None:
+                    done = previous.shape_pairs.get(shape_id, frozenset())
+                    for segment in shape_segments:
+                        key = (shape_id, segment.prev_code, segment.code)
+                        if key in previous.polylines:
+                            polylines[key] = previous.polylines[key]
+                    shape_segments = [segment for segment in shape_segments if (segment.prev_code, segment.code) not in done]
+                if not shape_segments:
+                    continue
+                rows = db.get_shape_points(shape_id)
+                if len(rows) < 2:
+                    continue
+                points = planar([row['shape_pt_lat'] for row in rows], [row['shape_pt_lon'] for row in rows], cos_lat)
+                distances = [row['shape_dist_traveled'] for row in rows]
+                if any(distance is None for distance in distances):
+                    cum = np.concatenate([[0], np.cumsum(np.hypot(*np.diff(points, axis=0).T))])
+                else:
+                    cum = np.maximum.accumulate(np.asarray(distances, dtype=np.float64))
+                for segment in shape_segments:
+                    polyline = slice_shape(points, cum, segment, cos_lat)
+                    if polyline is not None:
+                        polylines[(shape_id, segment.prev_code, segment.code)] = polyline
+        return ProgressEngine(polylines, cos_lat, cut_pairs, [(segment.prev_code, segment.code) for segment in pairs])
+
+
+def slice_shape(points, cum, segment, cos_lat: float):
+    # Cuts the part of a shape between a segment's two stops, or None if the shape doesn't serve both in order
+    stops = planar([segment.prev_point[0], segment.point[0]], [segment.prev_point[1], segment.point[1]], cos_lat)
+    count = len(points) - 1
+    along, error = project(stops,
+                           np.broadcast_to(points[:-1], (2, count, 2)), np.broadcast_to(points[1:], (2, count, 2)),
+                           np.broadcast_to(cum[:-1], (2, count)), np.broadcast_to(cum[1:], (2, count)),
+                           np.ones((2, count), dtype=bool))
+    if (error > stop_tolerance ** 2).any() or along[0] >= along[1]:
+        return None
+    start, end = along
+    inside = (cum > start) & (cum < end)
+    sliced_cum = np.concatenate([[start], cum[inside], [end]])
+    sliced = np.stack([np.interp(sliced_cum, cum, points[:, 0]), np.interp(sliced_cum, cum, points[:, 1])], axis=-1)
+    return sliced, sliced_cum - start
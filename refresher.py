@@ -0,0 +1,132 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+import requests
+from transit import print_stopwatch
+
+
+def read_feed_version(archive: zipfile.ZipFile):
+    if 'feed_info.txt' not in archive.namelist():
+        return None
+    with archive.open('feed_info.txt') as raw:
+        for row in csv.DictReader(io.TextIOWrapper(raw, encoding='utf-8-sig')):
+            return row.get('feed_version') or None
+    return None
+
+
+class StaticRefresher:
+    """
+    Keeps db_path in sync with the static GTFS zip from a background thread.
+
+    Each check is a conditional GET on the ETag and Last-Modified of the last
+    download, whichever the server sent. A downloaded zip is then compared by
+    content hash and feed_info version against what the current database was built
+    from, and only a real change triggers a rebuild. The new database is built next to
+    db_path and moved over it with os.replace, then on_update(db_path) is called so the
+    app can reload its in-memory caches.
+    """
+
+    def __init__(self, static_url: str, db_path: str, on_update=None, interval: float = 6 * 60 * 60):
+        self.static_url = static_url
+        self.db_path = db_path
+        self.on_update = on_update
+        self.interval = interval
+        self.state_path = db_path + '.state.json'
+        self.session = requests.Session()
+        self.checks = 0
+        self.rebuilds = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, state: dict):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_path, self.state_path)
+
+    def download(self, state: dict, zip_path):
+        # Returns (etag, last_modified, sha256) of the new zip, or None if the server says it hasn't changed
+        headers = {}
+        if state.get('etag') is not None:
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified') is not None:
+            headers['If-Modified-Since'] = state['last_modified']
+        digest = hashlib.sha256()
+        with self.session.get(self.static_url, headers=headers, stream=True, timeout=(3.05, 60)) as response:
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+            with open(zip_path, 'wb') as zip_file:
+                for block in response.iter_content(chunk_size=1 << 20):
+                    digest.update(block)
+                    zip_file.write(block)
+            return response.headers.get('ETag'), response.headers.get('Last-Modified'), digest.hexdigest()
+
+    def check(self) -> bool:
+        self.checks += 1
+        state = self.load_state()
+        zip_path = self.db_path + '.download.zip'
+        tmp_db_path = self.db_path + '.building'
+        try:
+            downloaded = self.download(state, zip_path)
+            if downloaded is None:
+                return False
+            etag, last_modified, sha256 = downloaded
+            if sha256 == state.get('sha256'):
+                state.update(etag=etag, last_modified=last_modified)
+                self.save_state(state)
+                return False
+
+            with zipfile.ZipFile(zip_path) as archive:
+                version = read_feed_version(archive)
+                if version is not None and version == state.get('feed_version'):
+                    state.update(etag=etag, last_modified=last_modified, sha256=sha256)
+                    self.save_state(state)
+                    return False
+                # pandas comes in with ingest, only load it when there's something to build
+                from ingest import build_database
+                start_time = time.time()
+                if os.path.exists(tmp_db_path):
+                    os.remove(tmp_db_path)
+                build_database(archive, tmp_db_path)
+                print_stopwatch(time.time() - start_time, 'Rebuilt static GTFS {}'.format(version or sha256[:12]))
+
+            os.replace(tmp_db_path, self.db_path)
+            self.save_state({'etag': etag, 'last_modified': last_modified, 'sha256': sha256, 'feed_version': version})
+            self.rebuilds += 1
+        finally:
+            for path in (zip_path, tmp_db_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if self.on_update is not None:
+            self.on_update(self.db_path)
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                # Keep serving the database we have, try again next interval
+                print('Static GTFS refresh failed: {}'.format(e))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='static-refresher', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,186 @@
+import datetime
+import statistics
+import time
+from collections import deque
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+weekdays = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+
+def parse_gtfs_date(value) -> datetime.date:
+    return datetime.datetime.strptime(str(value), '%Y%m%d').date()
+
+
+class ServiceCalendar:
+    """
+    When the configured routes run. For every service_id of their trips, the
+    first departure and last arrival (seconds after midnight of the service day,
+    so past 24h for trips running after midnight), and the days it runs on from
+    calendar.txt with calendar_dates.txt exceptions applied.
+
+    All of it is in the agency's timezone from agency.txt, not the one the Pi
+    happens to be set to; without one the local timezone is assumed.
+    """
+
+    def __init__(self, spans: dict, calendar: list, calendar_dates: list, timezone: str = None):
+        self.spans = spans
+        self.zone = ZoneInfo(timezone) if timezone else None
+        self.weekly = {}
+        for row in calendar:
+            days = {index for index, day in enumerate(weekdays) if str(row.get(day)) == '1'}
+            self.weekly[row.get('service_id')] = (parse_gtfs_date(row.get('start_date')), parse_gtfs_date(row.get('end_date')), days)
+        self.added = {}
+        self.removed = {}
+        for row in calendar_dates:
+            exceptions = self.added if str(row.get('exception_type')) == '1' else self.removed
+            exceptions.setdefault(parse_gtfs_date(row.get('date')), set()).add(row.get('service_id'))
+
+    def services(self, date: datetime.date) -> set:
+        active = set(self.added.get(date, ()))
+        for service_id, (start_date, end_date, days) in self.weekly.items():
+            if start_date <= date <= end_date and date.weekday() in days:
+                active.add(service_id)
+        return active - self.removed.get(date, set())
+
+    def local_time(self, now: float) -> datetime.datetime:
+        # A timestamp as the agency's wall clock time
+        return datetime.datetime.fromtimestamp(now, self.zone)
+
+    def windows(self, date: datetime.date):
+        # (start, end) datetimes of every active service on the service day starting at date.
+        # GTFS times count from noon minus 12h, which is not midnight on DST changeover days.
+        noon = datetime.datetime.combine(date, datetime.time(12), tzinfo=self.zone)
+        if self.zone is not None:
+            noon = noon.astimezone(datetime.timezone.utc)
+        midnight = noon - datetime.timedelta(hours=12)
+        for service_id in self.services(date):
+            span = self.spans.get(service_id)
+            if span is not None:
+                yield midnight + datetime.timedelta(seconds=span[0]), midnight + datetime.timedelta(seconds=span[1])
+
+    def in_service(self, now: datetime.datetime, margin: float = 0) -> bool:
+        slack = datetime.timedelta(seconds=margin)
+        # Yesterday's late trips can still be running after midnight
+        for date in (now.date() - datetime.timedelta(days=1), now.date()):
+            for start, end in self.windows(date):
+                if start - slack <= now <= end + slack:
+                    return True
+        return False
+
+    def next_start(self, now: datetime.datetime, margin: float = 0, days: int = 7):
+        # Earliest service start (less margin) after now within the next few days, or None
+        slack = datetime.timedelta(seconds=margin)
+        starts = [start - slack
+                  for offset in range(days + 1)
+                  for start, _ in self.windows(now.date() + datetime.timedelta(days=offset))
+                  if start - slack > now]
+        return min(starts, default=None)
+
+    @staticmethod
+    def Build(db, route_ids):
+        # None when gtfs_db has no calendar or trip spans, i.e. assume the routes always run
+        spans = db.get_service_spans(route_ids)
+        calendar = db.get_calendar()
+        calendar_dates = db.get_calendar_dates()
+        if not spans or not (calendar or calendar_dates):
+            return None
+        timezone = db.get_agency_timezone()
+        try:
+            return ServiceCalendar(spans, calendar, calendar_dates, timezone)
+        except (ZoneInfoNotFoundError, ValueError) as e:
+            print('Unknown agency timezone {!r}, using the local one: {}'.format(timezone, e))
+            return ServiceCalendar(spans, calendar, calendar_dates)
+
+
+class PollScheduler:
+    """
+    Decides how long to wait before the next feed poll.
+
+    The publish cadence is learned from successive FeedHeader.timestamps (median of
+    the recent intervals), along with the shortest delay seen between a timestamp
+    and us getting the feed. Polls are then timed for just after the next expected
+    publish. Errors and unchanged feeds back off exponentially. Outside the
+    configured routes' service hours, polling drops to idle_interval or waits for
+    the next service start, whichever comes first. During service an unchanged
+    feed is never waited on for more than one cadence.
+    """
+
+    def __init__(self, fetcher, base_interval: float = 8, service=None, min_interval: float = 1,
+                 max_backoff: float = 120, idle_interval: float = 300, publish_margin: float = 0.5,
+                 service_margin: float = 15 * 60, history: int = 16):
+        self.fetcher = fetcher
+        self.base_interval = base_interval
+        # Callable returning the current ServiceCalendar or None, it is swapped along with the static data
+        self.service = service
+        self.min_interval = min_interval
+        self.max_backoff = max_backoff
+        self.idle_interval = idle_interval
+        self.publish_margin = publish_margin
+        self.service_margin = service_margin
+        self.intervals = deque(maxlen=history)
+        self.lags = deque(maxlen=history)
+        self.last_timestamp = None
+        self.errors = 0
+        self.unchanged = 0
+        self.idle_polls = 0
+        self.last_delay = 0.0
+
+    def cadence(self) -> float:
+        if len(self.intervals) < 3:
+            return self.base_interval
+        return min(max(statistics.median(self.intervals), self.min_interval), self.max_backoff)
+
+    def backoff(self, attempt: int, base: float) -> float:
+        return min(base * 2 ** (attempt - 1), self.max_backoff)
+
+    def after_poll(self, changed: bool, failed: bool = False, now: float = None) -> float:
+        now = time.time() if now is None else now
+        if failed:
+            self.errors += 1
+            delay = self.backoff(self.errors, self.base_interval)
+        else:
+            self.errors = 0
+            if changed:
+                delay = self.on_new_feed(now)
+            else:
+                # Retry soon after a poll that just missed the publish, never waiting more than one cadence
+                self.unchanged += 1
+                delay = min(self.backoff(self.unchanged, self.min_interval), self.cadence())
+        delay = self.outside_service(now, delay)
+        self.last_delay = delay
+        return delay
+
+    def on_new_feed(self, now: float) -> float:
+        self.unchanged = 0
+        timestamp = self.fetcher.last_timestamp
+        if not timestamp:
+            return self.base_interval
+        if self.last_timestamp is not None and timestamp > self.last_timestamp:
+            self.intervals.append(timestamp - self.last_timestamp)
+        self.last_timestamp = timestamp
+        self.lags.append(max(now - timestamp, 0))
+        expected = timestamp + self.cadence() + min(self.lags) + self.publish_margin
+        return max(expected - now, self.min_interval)
+
+    def outside_service(self, now: float, delay: float) -> float:
+        calendar = self.service() if self.service is not None else None
+        if calendar is None:
+            return delay
+        local_now = calendar.local_time(now)
+        if calendar.in_service(local_now, self.service_margin):
+            return delay
+        self.idle_polls += 1
+        next_start = calendar.next_start(local_now, self.service_margin)
+        if next_start is None:
+            return max(delay, self.idle_interval)
+        return max(delay, min(self.idle_interval, (next_start - local_now).total_seconds()))
+
+    def stats(self):
+        return {
+            'cadence': self.cadence(),
+            'publish_lag': min(self.lags) if self.lags else 0,
+            'errors': self.errors,
+            'unchanged': self.unchanged,
+            'idle_polls': self.idle_polls,
+            'last_delay': self.last_delay,
+        }
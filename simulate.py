@@ -0,0 +1,266 @@
+"""
+Runs the LED map without hardware. Snapshots, recorded or synthetic, go through the
+same decode/compute/paint path as app.py into in-memory strips, on a simulated clock
+taken from the feed header timestamps, as fast as possible or at N x real time.
+Frames are written to a compact binary log and/or drawn in the terminal.
+
+    python simulate.py --feeds recorded/*.pb --gtfs-db gtfs.db --speed 10 --terminal
+    python simulate.py --synthetic 400 --leds 200 --duration 86400 --log day.ledlog
+"""
+import argparse
+import glob
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+from strip_config import LightStatus, palette, light_colors, stop_radius
+from realtime import parse_feed, decode_vehicle_positions
+from gtfs_db import GtfsDatabase
+from frames import StaticData, group_vehicles, compute_motion, paint
+from framebuffer import Framebuffer
+from output import OutputDriver
+
+poll_interval = 8
+# Bytes read from the start of a recording to find its FeedHeader
+header_prefix = 4096
+colors = palette(light_colors)
+
+# File header: magic, version, strip count, then (id, length) for every strip.
+# Each frame: simulated time and the number of strips that changed, then for each
+# of those its id and 3 bytes of RGB per pixel. Unchanged frames aren't written.
+log_magic = b'LEDF'
+log_version = 1
+header_format = struct.Struct('<4sHH')
+strip_format = struct.Struct('<HH')
+frame_format = struct.Struct('<dH')
+
+
+def pack_pixels(pixels) -> bytes:
+    return b''.join(color.to_bytes(3, 'big') for color in pixels)
+
+
+class FrameLog:
+    def __init__(self, path: str, strip_lengths: dict):
+        self.file = open(path, 'wb')
+        self.file.write(header_format.pack(log_magic, log_version, len(strip_lengths)))
+        for idx, length in strip_lengths.items():
+            self.file.write(strip_format.pack(idx, length))
+        self.frames = 0
+
+    def write(self, timestamp: float, framebuffer, dirty):
+        if not dirty:
+            return
+        self.file.write(frame_format.pack(timestamp, len(dirty)))
+        for idx in sorted(dirty):
+            pixels = framebuffer.pixels[idx]
+            self.file.write(strip_format.pack(idx, len(pixels)))
+            self.file.write(pack_pixels(pixels))
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_frame_log(path: str):
+    # Yields (timestamp, {strip id: [color, ...]}) with every strip's full state at that frame
+    with open(path, 'rb') as log_file:
+        magic, version, strip_count = header_format.unpack(log_file.read(header_format.size))
+        if magic != log_magic or version != log_version:
+            raise ValueError('{} is not a version {} frame log'.format(path, log_version))
+        strips = {}
+        for _ in range(strip_count):
+            idx, length = strip_format.unpack(log_file.read(strip_format.size))
+            strips[idx] = [0] * length
+        while True:
+            record = log_file.read(frame_format.size)
+            if len(record) < frame_format.size:
+                return
+            timestamp, changed = frame_format.unpack(record)
+            for _ in range(changed):
+                idx, length = strip_format.unpack(log_file.read(strip_format.size))
+                data = log_file.read(length * 3)
+                strips[idx] = [int.from_bytes(data[i:i + 3], 'big') for i in range(0, len(data), 3)]
+            yield timestamp, {idx: list(pixels) for idx, pixels in strips.items()}
+
+
+class TerminalRenderer:
+    # One row of 24-bit colour blocks per strip, redrawn in place
+    def __init__(self, width: int = 100):
+        self.width = width
+        self.frames = 0
+
+    def write(self, timestamp: float, framebuffer, dirty):
+        lines = ['\x1b[H\x1b[2J{}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)))]
+        for idx, pixels in framebuffer.pixels.items():
+            for offset in range(0, len(pixels), self.width):
+                blocks = ''.join('\x1b[38;2;{};{};{}m█'.format(color >> 16, (color >> 8) & 0xFF, color & 0xFF)
+                                 for color in pixels[offset:offset + self.width])
+                lines.append('{:>3}:{:<4} {}\x1b[0m'.format(idx, offset, blocks))
+        print('\n'.join(lines), flush=True)
+        self.frames += 1
+
+    def close(self):
+        pass
+
+
+class Simulator:
+    """
+    Drives a sequence of feed snapshots through the frame path, on a clock taken
+    from their header timestamps. speed=0 runs flat out, otherwise simulated time
+    passes speed times faster than the wall clock. With fps, frames are also
+    rendered between snapshots with vehicles moved along by dead reckoning.
+    """
+
+    def __init__(self, data, strip_lengths: dict, sinks, speed: float = 0, fps: float = 0):
+        self.data = data
+        self.framebuffer = Framebuffer(strip_lengths, light_colors.get(LightStatus.EMPTY))
+        self.output = OutputDriver.InMemory(strip_lengths)
+        self.sinks = sinks
+        self.speed = speed
+        self.fps = fps
+        self.snapshots = 0
+        self.vehicles = 0
+        self.rendered = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.wall_start = None
+
+    def decode(self, content: bytes):
+        feed = parse_feed(content)
+        batch = decode_vehicle_positions(feed, self.data.routes_by_id.keys())
+        motion = compute_motion(self.data, group_vehicles(self.data, batch), log=None)
+        self.snapshots += 1
+        self.vehicles += len(batch)
+        return feed.header.timestamp, motion
+
+    def render(self, timestamp: float, motion):
+        paint(self.framebuffer, motion.at(timestamp), colors)
+        dirty = self.output.push(self.framebuffer)
+        self.rendered += 1
+        if self.speed > 0:
+            # Hold the simulated clock to speed x the wall clock
+            delay = (timestamp - self.first_timestamp) / self.speed - (time.monotonic() - self.wall_start)
+            if delay > 0:
+                time.sleep(delay)
+        for sink in self.sinks:
+            sink.write(timestamp, self.framebuffer, dirty)
+
+    def run(self, snapshots):
+        self.wall_start = time.monotonic()
+        motion = None
+        for content in snapshots:
+            timestamp, next_motion = self.decode(content)
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+            if motion is not None and self.fps > 0:
+                tick = self.last_timestamp + 1 / self.fps
+                while tick < timestamp:
+                    self.render(tick, motion)
+                    tick += 1 / self.fps
+            motion = next_motion
+            self.last_timestamp = timestamp
+            self.render(timestamp, motion)
+        for sink in self.sinks:
+            sink.close()
+        return time.monotonic() - self.wall_start
+
+
+def header_timestamp(path: str) -> int:
+    # Only the FeedHeader is parsed, it is field 1 and producers write it first
+    from google.transit import gtfs_realtime_pb2
+    with open(path, 'rb') as feed_file:
+        prefix = feed_file.read(header_prefix)
+    if prefix[:1] == b'\x0a':
+        length, shift, position = 0, 0, 1
+        while position < len(prefix) and position < 6:
+            byte = prefix[position]
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            position += 1
+            if not byte & 0x80:
+                if position + length <= len(prefix):
+                    header = gtfs_realtime_pb2.FeedHeader()
+                    header.ParseFromString(prefix[position:position + length])
+                    return header.timestamp
+                break
+    with open(path, 'rb') as feed_file:
+        return parse_feed(feed_file.read()).header.timestamp
+
+
+def recorded_snapshots(paths):
+    # Ordered by their own header timestamps, not file names, and read one at a time
+    for _, path in sorted((header_timestamp(path), path) for path in paths):
+        with open(path, 'rb') as feed_file:
+            yield feed_file.read()
+
+
+def synthetic_snapshots(network, vehicle_count: int, duration: float, start: int, seed: int):
+    for step in range(int(duration // poll_interval) + 1):
+        elapsed = step * poll_interval
+        yield network.feed(vehicle_count, seed=seed, timestamp=start + elapsed, elapsed=elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--feeds', nargs='+', help='Recorded vehiclepositions.pb files (globs are expanded), replayed in timestamp order')
+    parser.add_argument('--gtfs-db', default=os.getenv('gtfs_db'))
+    parser.add_argument('--strips', default='strips.json')
+    parser.add_argument('--output', default='output.json')
+    parser.add_argument('--synthetic', type=int, metavar='VEHICLES', help='Simulate a synthetic network with this many vehicles')
+    parser.add_argument('--leds', type=int, default=200, help='LED count of the synthetic layout')
+    parser.add_argument('--duration', type=float, default=3600, help='Seconds of synthetic service to simulate')
+    parser.add_argument('--start', type=int, default=1700000000, help='Synthetic start time (unix seconds)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--speed', type=float, default=0, help='Times real time, 0 for as fast as possible')
+    parser.add_argument('--fps', type=float, default=0, help='Also render dead-reckoned frames between snapshots at this rate')
+    parser.add_argument('--log', help='Write frames to this binary frame log')
+    parser.add_argument('--terminal', action='store_true', help='Draw frames in the terminal')
+    args = parser.parse_args()
+
+    if (args.feeds is None) == (args.synthetic is None):
+        parser.error('pass exactly one of --feeds or --synthetic')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.synthetic is not None:
+            from synthetic import Network
+            network = Network(args.leds)
+            led_config, led_total = network.led_config()
+            strip_lengths = network.strip_lengths(led_total)
+            db_path = os.path.join(workdir, 'synthetic.db')
+            network.build_database(db_path)
+            snapshots = synthetic_snapshots(network, args.synthetic, args.duration, args.start, args.seed)
+        else:
+            if args.gtfs_db is None:
+                parser.error('--feeds needs --gtfs-db (or the gtfs_db environment variable)')
+            with open(args.strips) as json_data:
+                led_config = json.load(json_data)
+            with open(args.output) as json_data:
+                strip_lengths = {int(strip['id']): int(strip['length']) for strip in json.load(json_data).get('strips', [])}
+            db_path = args.gtfs_db
+            paths = sorted(path for pattern in args.feeds for path in (glob.glob(pattern) or [pattern]))
+            snapshots = recorded_snapshots(paths)
+
+        data = StaticData(GtfsDatabase(db_path), led_config, strip_lengths, stop_radius)
+        sinks = []
+        frame_log = None
+        if args.log:
+            frame_log = FrameLog(args.log, strip_lengths)
+            sinks.append(frame_log)
+        if args.terminal:
+            sinks.append(TerminalRenderer())
+
+        simulator = Simulator(data, strip_lengths, sinks, args.speed, args.fps)
+        wall = simulator.run(snapshots)
+
+    simulated = (simulator.last_timestamp or 0) - (simulator.first_timestamp or 0)
+    print('Simulated {:.0f}s of service in {:.2f}s ({} snapshots, {} vehicles decoded, {} frames rendered)'.format(
+        simulated, wall, simulator.snapshots, simulator.vehicles, simulator.rendered), file=sys.stderr)
+    if frame_log is not None:
+        print('Wrote {} changed frames, {} bytes to {}'.format(
+            frame_log.frames, os.path.getsize(args.log), args.log), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
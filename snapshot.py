@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import pickle
+from frames import StaticData
+
+# Bump whenever StaticData or anything it holds changes shape
+snapshot_version = 9
+
+
+def gtfs_version(db_path: str) -> dict:
+    # What the refresher recorded about the zip the database was built from, plus the file itself
+    version = {}
+    try:
+        with open(db_path + '.state.json') as state_file:
+            state = json.load(state_file)
+        version['sha256'] = state.get('sha256')
+        version['feed_version'] = state.get('feed_version')
+    except (OSError, ValueError):
+        pass
+    stat = os.stat(db_path)
+    version['size'] = stat.st_size
+    version['mtime'] = stat.st_mtime_ns
+    return version
+
+
+def snapshot_key(db_path: str, led_config: dict, strip_lengths: dict, stop_radius: float) -> str:
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        'snapshot_version': snapshot_version,
+        'gtfs': gtfs_version(db_path),
+        'strip_lengths': sorted(strip_lengths.items()),
+        'stop_radius': stop_radius,
+    }, sort_keys=True).encode())
+    # Hash of the strips.json content, so reformatting the file doesn't invalidate anything
+    digest.update(json.dumps(led_config, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def load_snapshot(path: str, key: str):
+    # The key is the file's first line, a stale snapshot is rejected without unpickling it
+    try:
+        with open(path, 'rb') as snapshot_file:
+            if snapshot_file.readline().rstrip(b'\n') != key.encode():
+                return None
+            return pickle.load(snapshot_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        print('Ignoring unreadable snapshot {}: {}'.format(path, e))
+        return None
+
+
+def save_snapshot(path: str, key: str, data: StaticData):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(key.encode() + b'\n')
+        pickle.dump(data, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_static(db, led_config: dict, strip_lengths: dict, stop_radius: float, snapshot_path: str = None):
+    """
+    StaticData for db from the snapshot at snapshot_path when it was built from the
+    same database, strips.json and strips, otherwise built from db and saved there.
+    Returns (data, True if it came from the snapshot).
+    """
+    if snapshot_path is None:
+        snapshot_path = db.path + '.snapshot'
+    key = snapshot_key(db.path, led_config, strip_lengths, stop_radius)
+    data = load_snapshot(snapshot_path, key)
+    if data is not None:
+        return data.attach(db), True
+
+    data = StaticData(db, led_config, strip_lengths, stop_radius)
+    save_static(data, snapshot_path)
+    return data, False
+
+
+def snapshot_location(data: StaticData, snapshot_path: str = None) -> tuple:
+    # (path, key) load_static looks data's snapshot up by
+    if snapshot_path is None:
+        snapshot_path = data.db.path + '.snapshot'
+    return snapshot_path, snapshot_key(data.db.path, data.led_config, data.strip_lengths, data.stop_radius)
+
+
+def save_static(data: StaticData, snapshot_path: str = None):
+    # Snapshot of data under the key load_static will look it up by, e.g. after StaticData.reconfigure
+    snapshot_path, key = snapshot_location(data, snapshot_path)
+    try:
+        save_snapshot(snapshot_path, key, data)
+    except OSError as e:
+        print('Could not write snapshot {}: {}'.format(snapshot_path, e))
@@ -0,0 +1,91 @@
+import math
+
+# Vehicles further than this (degrees of latitude) from every configured segment aren't placed
+snap_tolerance = 0.003
+
+
+def point_segment_distance(px, py, x1, y1, x2, y2) -> float:
+    dx = x2 - x1
+    dy = y2 - y1
+    length = dx * dx + dy * dy
+    t = 0 if length == 0 else max(0, min(1, ((px - x1) * dx + (py - y1) * dy) / length))
+    return math.hypot(px - (x1 + t * dx), py - (y1 + t * dy))
+
+
+class SegmentGrid:
+    """
+    Uniform grid over the configured segments of every (route, direction). Used to
+    work out which stop a vehicle is heading to from its position alone, when the
+    feed's stop_id is missing or doesn't match where the vehicle actually is.
+
+    Each segment is stored under the stop it leads to. The first stop of a direction
+    has no segment into it, so it is stored as a single point.
+    """
+
+    def __init__(self, cos_lat: float, cell_size: float = snap_tolerance):
+        self.cos_lat = cos_lat
+        self.cell_size = cell_size
+        self.cells = {}
+        self.segments = {}
+
+    def cell(self, x: float, y: float):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def add(self, route_short_name: str, direction: int, code: int, start: tuple, end: tuple):
+        x1, y1 = start[1] * self.cos_lat, start[0]
+        x2, y2 = end[1] * self.cos_lat, end[0]
+        segment = (route_short_name, direction, code, x1, y1, x2, y2)
+        self.segments[(route_short_name, direction, code)] = segment
+        # Register in every cell the segment's bounding box touches
+        cx1, cy1 = self.cell(min(x1, x2), min(y1, y2))
+        cx2, cy2 = self.cell(max(x1, x2), max(y1, y2))
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                self.cells.setdefault((cx, cy), []).append(segment)
+
+    def distance(self, route_short_name: str, direction: int, code: int, latitude: float, longitude: float):
+        segment = self.segments.get((route_short_name, direction, code))
+        if segment is None:
+            return math.inf
+        return point_segment_distance(longitude * self.cos_lat, latitude, *segment[3:])
+
+    def is_near(self, route_short_name: str, direction: int, code: int, latitude: float, longitude: float) -> bool:
+        return self.distance(route_short_name, direction, code, latitude, longitude) <= snap_tolerance
+
+    def nearest(self, route_short_name: str, direction: int, latitude: float, longitude: float):
+        # Stop code of the closest segment within snap_tolerance, or None
+        px = longitude * self.cos_lat
+        py = latitude
+        cx, cy = self.cell(px, py)
+        best_code = None
+        best = (snap_tolerance, math.inf)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for segment in self.cells.get((cx + dx, cy + dy), ()):
+                    if segment[0] != route_short_name or segment[1] != direction:
+                        continue
+                    # Ties (a vehicle right at a stop touches the segments on both sides) go to the stop it's at
+                    candidate = (point_segment_distance(px, py, *segment[3:]), math.hypot(px - segment[5], py - segment[6]))
+                    if candidate <= best:
+                        best_code = segment[2]
+                        best = candidate
+        return best_code
+
+    @staticmethod
+    def Build(layout, stops_by_code: dict):
+        coordinates = {}
+        for stop_leds in layout.stops.values():
+            stop = stops_by_code.get(stop_leds.code)
+            if stop is not None:
+                coordinates[stop_leds.code] = (float(stop.latitude), float(stop.longitude))
+        if not coordinates:
+            return SegmentGrid(1.0)
+        mean_latitude = sum(point[0] for point in coordinates.values()) / len(coordinates)
+        grid = SegmentGrid(math.cos(math.radians(mean_latitude)))
+        for stop_leds in layout.stops.values():
+            end = coordinates.get(stop_leds.code)
+            if end is None:
+                continue
+            start = end if stop_leds.prev is None else coordinates.get(stop_leds.prev.code, end)
+            grid.add(stop_leds.route_short_name, stop_leds.direction, stop_leds.code, start, end)
+        return grid
@@ -1,12 +1,30 @@
-from transit import Stop, Vehicle
-import math
+import numpy as np
 from enum import Enum
 
 class LightStatus(Enum):
-    EMPTY = 0,
-    STATION = 1,
+    # The values are the codes StripConfig keeps per LED
+    EMPTY = 0
+    STATION = 1
     OCCUPIED = 2
 
+
+def palette(light_colors: dict) -> np.ndarray:
+    # Colors indexed by LightStatus code, palette[codes] colors a whole strip at once
+    colors = np.zeros(max(status.value for status in LightStatus) + 1, dtype=np.uint32)
+    for status, color in light_colors.items():
+        colors[status.value] = color
+    return colors
+
+
+# Shared by app.py and the offline tools, so a simulation looks like the real map
+light_colors = {
+    LightStatus.EMPTY: 0x000000,
+    LightStatus.STATION: 0xFFD700,
+    LightStatus.OCCUPIED: 0x3DAE2B
+}
+# Side of the BoundingArea around each configured stop, in degrees
+stop_radius = 0.002
+
 class BoundingArea:
     def __init__(self, x1: float, y1: float, x2: float, y2: float):
         self.X1 = x1
@@ -30,95 +48,99 @@ class BoundingArea:
         x2 = x + from_center_offset
         y2 = y + from_center_offset
         return BoundingArea(x1, y1, x2, y2)
-    
-    def distance(self, x1, y1, x2, y2):
-        return math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-
-    def calculate_percentage(self, area2, point: tuple):
-        # Unpack point coordinates
-        px, py = point
-
-        # Calculate the relevant edges:
-        # For area1, use the farthest edge in the direction of area2
-        # For area2, use the closest edge in the direction from area1
-        
-        # Assuming that the two BoundingAreas are aligned (i.e., area2 is always to the right and downwards of area1):
-        area1_edge_x = self.X2  # Right edge of the first area
-        area1_edge_y = self.Y2  # Bottom edge of the first area
-        area2_edge_x = area2.X1  # Left edge of the second area
-        area2_edge_y = area2.Y1  # Top edge of the second area
-
-        # Calculate total distance between edges
-        total_distance = self.distance(area1_edge_x, area1_edge_y, area2_edge_x, area2_edge_y)
-
-        # Calculate distance from area1 edge to the point
-        distance_to_point = self.distance(area1_edge_x, area1_edge_y, px, py)
-
-        # Calculate the percentage as a ratio of these distances
-        percentage = distance_to_point / total_distance
-
-        # Ensure the percentage is between 0 and 1
-        return max(0, min(1, percentage))
-
-class LightStop:
-    def __init__(self, stop: Stop, light_index: int) -> None:
-        self.stop = stop
-        self.light_index = light_index
-        self.bounding = BoundingArea.FromPoint(self.stop.latitude, self.stop.longitude, 0.1)
-
-    def is_vehicle_in_stop(self, vehicle: Vehicle):
-        if vehicle.stop_id == self.stop.id:
-            # Okay so it's at least headed to the next stop, but is it within the bounding box?
-            if self.bounding.contains(vehicle.latitude, vehicle.longitude):
-                return True
-        return False
-
-class Light:
-    def __init__(self, status: LightStatus):
-        self.status = status
-
-class StripConfig:
-    def __init__(self, stops: list[LightStop]) -> None:
-        self.stops = stops
-        self.stops_by_light_id = {}
-        self.stops_by_stop_id = {}
-        for stop in stops:
-            self.stops_by_light_id[stop.light_index] = stop
-            self.stops_by_stop_id[stop.stop.id] = stop
-
-    def find_last_stop(self, current_stop: LightStop) -> LightStop:
-        current_index = len(self.stops) - 1
-        while self.stops[current_index].stop.id != current_stop.stop.id and current_index >= 0:
-            current_index -= 1
-        return self.stops[current_index - 1]
-
-    def calculate_strip(self, vehicles: list[Vehicle]):
-        status = []
-        counter = 0
-        while (counter < self.stops[-1].light_index):
-            stop_light = self.stops_by_light_id.get(counter)
-            counter += 1
-            if stop_light is None:
-                status.append(Light(LightStatus.EMPTY))
-            else:
-                status.append(Light(LightStatus.STATION))
-
-        for vehicle in vehicles:
-            stop: LightStop = self.stops_by_stop_id.get(vehicle.stop_id)
-            if (stop is None):
-                # This can happen because the stop is out of range of our strip
-                continue
-            if (stop.is_vehicle_in_stop(vehicle)):
-                status[stop.light_index] = Light(LightStatus.OCCUPIED)
-            else:
-                last_stop = self.find_last_stop(stop)
-                intermediary_stops = stop.light_index - last_stop.light_index - 1
-                percentage_trip = self.calculate_percentage(last_stop.bounding, stop.bounding, (vehicle.latitude, vehicle.longitude))
-                current_intermediary = round(percentage_trip * intermediary_stops)
-                # So last stop + current_intermediary is occupied
-                status[last_stop.light_index + current_intermediary] = Light(LightStatus.OCCUPIED)
-
-        return status
-
 
 
+class StripConfig:
+    """
+    The LED status of every strip, kept as one flat array of LightStatus codes
+    (strip by strip, in strip id order) with stations lit in the base copy.
+
+    Every stop in the layout gets a row: the flat index of its own LED, the row
+    of the stop before it in its direction (-1 for the first one) and its loading
+    LEDs with their percentage thresholds, padded to the longest approach.
+    A loading LED's percentage is the upper bound of the progress it shows, from
+    0 at the previous stop to 1 at this one: a vehicle lights the first loading
+    LED whose percentage is at or above its progress, or the last one past them all.
+    calculate_strip() places a whole frame's vehicles from these rows with a few
+    array operations, and only undoes the LEDs it lit the frame before, so its
+    cost depends on the number of vehicles, not on the length of the strips.
+    """
+
+    def __init__(self, layout, strip_lengths: dict):
+        self.lengths = dict(sorted(strip_lengths.items()))
+        self.offsets = {}
+        total = 0
+        for idx, length in self.lengths.items():
+            self.offsets[idx] = total
+            total += length
+
+        self.stops = list(layout.stops.values())
+        self.rows = {(stop.route_short_name, stop.direction, stop.code): row for row, stop in enumerate(self.stops)}
+        self.prev_rows = [-1 if stop.prev is None else self.rows[(stop.prev.route_short_name, stop.prev.direction, stop.prev.code)]
+                          for stop in self.stops]
+        self.stop_leds = np.array([self.flat_index(stop.led) for stop in self.stops], dtype=np.intp)
+        width = max([len(stop.thresholds) for stop in self.stops] + [1])
+        # Padding thresholds are never reached and padding LEDs are -1, stops without loading LEDs have only padding
+        self.thresholds = np.full((len(self.stops), width), np.inf)
+        self.loading_counts = np.array([len(stop.loading_leds) for stop in self.stops], dtype=np.intp)
+        self.loading_leds = np.full((len(self.stops), width), -1, dtype=np.intp)
+        for row, stop in enumerate(self.stops):
+            self.thresholds[row, :len(stop.thresholds)] = stop.thresholds
+            self.loading_leds[row, :len(stop.loading_leds)] = [self.flat_index(led) for led in stop.loading_leds]
+
+        self.base = np.full(total, LightStatus.EMPTY.value, dtype=np.uint8)
+        for route_short_name in layout.route_names():
+            for led in layout.route_stations(route_short_name):
+                self.base[self.flat_index(led)] = LightStatus.STATION.value
+        self.allocate()
+
+    def allocate(self):
+        # The status array is rewritten in place every frame, views are the per-strip slices of it
+        self.status = self.base.copy()
+        self.written = np.zeros(0, dtype=np.intp)
+        self.views = {idx: self.status[offset:offset + self.lengths[idx]] for idx, offset in self.offsets.items()}
+
+    def __getstate__(self):
+        # Views would be pickled as copies of the status array, see snapshot.py
+        state = self.__dict__.copy()
+        for name in ('status', 'written', 'views'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.allocate()
+
+    def __len__(self):
+        return len(self.base)
+
+    def flat_index(self, led: tuple) -> int:
+        strip_index, led_index = led
+        return self.offsets[strip_index] + led_index
+
+    def row(self, route_short_name: str, direction: int, stop_code: int):
+        return self.rows.get((route_short_name, direction, stop_code))
+
+    def prev_stop(self, row: int):
+        prev_row = self.prev_rows[row]
+        return None if prev_row < 0 else self.stops[prev_row]
+
+    def calculate_strip(self, stopped, moving, progress) -> dict:
+        """
+        Lights the LED of every stop row in stopped, and for every stop row in
+        moving the loading LED matching the vehicle's progress towards it.
+        Returns {strip id: array of LightStatus codes}, views that are only valid
+        until the next call.
+        """
+        status = self.status
+        status[self.written] = self.base[self.written]
+        stopped_leds = self.stop_leds[np.asarray(stopped, dtype=np.intp)]
+        moving = np.asarray(moving, dtype=np.intp)
+        progress = np.asarray(progress, dtype=np.float64)
+        # First threshold at or above the progress, falling back to the last one
+        slots = (self.thresholds[moving] < progress[:, None]).sum(axis=1)
+        slots = np.maximum(np.minimum(slots, self.loading_counts[moving] - 1), 0)
+        moving_leds = self.loading_leds[moving, slots]
+        self.written = np.concatenate([stopped_leds, moving_leds[moving_leds >= 0]])
+        status[self.written] = LightStatus.OCCUPIED.value
+        return self.views
@@ -0,0 +1,182 @@
+"""
+Synthetic GTFS networks, strips.json layouts and VehiclePositions feeds, so the
+pipeline can be exercised at any scale without a Pi, a network or the real feed.
+"""
+import io
+import math
+import random
+import os
+import zipfile
+from google.transit import gtfs_realtime_pb2
+
+origin = (47.5, -122.4)
+stop_spacing = 0.004
+meters_per_degree = 111320
+trips_per_direction = 20
+loading_per_stop = 2
+noise_route_id = 800000
+
+
+class Network:
+    """A grid of straight east/west routes, laid out so the LED count lands near led_count."""
+
+    def __init__(self, led_count: int, strip_length: int = 300, trips: int = trips_per_direction):
+        leds_per_stop = loading_per_stop + 1
+        self.stops_per_direction = min(20, max(2, (led_count + loading_per_stop) // leds_per_stop))
+        leds_per_direction = self.stops_per_direction * leds_per_stop - loading_per_stop
+        self.direction_count = max(1, math.ceil(led_count / leds_per_direction))
+        self.route_count = math.ceil(self.direction_count / 2)
+        self.strip_length = strip_length
+        self.trips_per_direction = trips
+
+    def directions(self):
+        # (route_index, direction) for every configured direction
+        for index in range(self.direction_count):
+            yield index // 2, index % 2
+
+    @staticmethod
+    def route_id(route_index: int) -> int:
+        return 900000 + route_index
+
+    @staticmethod
+    def route_name(route_index: int) -> str:
+        return 'R{}'.format(route_index)
+
+    @staticmethod
+    def shape_id(route_index: int, direction: int) -> int:
+        return route_index * 2 + direction + 1
+
+    def stop_code(self, route_index: int, direction: int, position: int) -> int:
+        return 1000000 + route_index * 1000 + direction * 500 + position
+
+    def trip_id(self, route_index: int, direction: int, number: int) -> int:
+        return 10000000 + (route_index * 2 + direction) * self.trips_per_direction + number
+
+    def stop_point(self, route_index: int, direction: int, position: int):
+        # Direction 1 runs back along the other side of the street
+        along = position if direction == 0 else self.stops_per_direction - 1 - position
+        latitude = origin[0] + route_index * 0.01 + direction * 0.0005
+        longitude = origin[1] + along * stop_spacing
+        return latitude + 0.0004 * math.sin(along), longitude
+
+    def point_between(self, route_index: int, direction: int, position: int, fraction: float):
+        # Somewhere between stop position - 1 and stop position
+        lat1, lon1 = self.stop_point(route_index, direction, position - 1)
+        lat2, lon2 = self.stop_point(route_index, direction, position)
+        return lat1 + (lat2 - lat1) * fraction, lon1 + (lon2 - lon1) * fraction
+
+    def gtfs_zip(self) -> bytes:
+        routes = ['route_id,agency_id,route_short_name,route_long_name,route_desc,route_type']
+        trips = ['route_id,service_id,trip_id,trip_headsign,direction_id,shape_id']
+        stops = ['stop_id,stop_code,stop_name,stop_lat,stop_lon']
+        stop_times = ['trip_id,arrival_time,departure_time,stop_id,stop_sequence']
+        shapes = ['shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence,shape_dist_traveled']
+
+        routes.append('{},1,Noise,,,3'.format(noise_route_id))
+        for route_index in range(self.route_count):
+            routes.append('{},1,{},,,3'.format(self.route_id(route_index), self.route_name(route_index)))
+            for direction in (0, 1):
+                shape_id = self.shape_id(route_index, direction)
+                distance = 0.0
+                previous = None
+                for position in range(self.stops_per_direction):
+                    code = self.stop_code(route_index, direction, position)
+                    latitude, longitude = self.stop_point(route_index, direction, position)
+                    stops.append('{0},{0},Stop {0},{1:.6f},{2:.6f}'.format(code, latitude, longitude))
+                    if previous is not None:
+                        distance += math.hypot(latitude - previous[0], longitude - previous[1]) * 111000
+                    shapes.append('{},{:.6f},{:.6f},{},{:.1f}'.format(shape_id, latitude, longitude, position, distance))
+                    previous = (latitude, longitude)
+                for number in range(self.trips_per_direction):
+                    trip_id = self.trip_id(route_index, direction, number)
+                    trips.append('{},1,{},Synthetic,{},{}'.format(self.route_id(route_index), trip_id, direction, shape_id))
+                    for position in range(self.stops_per_direction):
+                        stop_times.append('{},08:00:00,08:00:00,{},{}'.format(
+                            trip_id, self.stop_code(route_index, direction, position), position + 1))
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, lines in (('routes', routes), ('trips', trips), ('stops', stops),
+                                ('stop_times', stop_times), ('shapes', shapes)):
+                archive.writestr(name + '.txt', '\n'.join(lines) + '\n')
+        return buffer.getvalue()
+
+    def build_database(self, db_path: str):
+        # Ingests gtfs_zip() into a fresh gtfs_db, the same way ingest.py builds the real one
+        from ingest import build_database
+        zip_path = db_path + '.zip'
+        with open(zip_path, 'wb') as zip_file:
+            zip_file.write(self.gtfs_zip())
+        try:
+            with zipfile.ZipFile(zip_path) as archive:
+                build_database(archive, db_path)
+        finally:
+            os.remove(zip_path)
+
+    def led_config(self):
+        # strips.json structure, filling strips of strip_length one after the other
+        config = {}
+        next_led = [0]
+
+        def allocate():
+            led = next_led[0]
+            next_led[0] += 1
+            return '{}:{}'.format(led // self.strip_length + 1, led % self.strip_length)
+
+        for route_index, direction in self.directions():
+            directional = {'direction': direction, 'stops': []}
+            for position in range(self.stops_per_direction):
+                loading = []
+                if position > 0:
+                    for step in range(loading_per_stop):
+                        # Upper bounds, the first loading LED covers progress up to 1 / loading_per_stop
+                        loading.append({'led': allocate(), 'percentage': (step + 1) / loading_per_stop})
+                directional['stops'].append({'code': self.stop_code(route_index, direction, position), 'led': allocate(), 'loading': loading})
+            config.setdefault(self.route_name(route_index), []).append(directional)
+        return config, next_led[0]
+
+    def strip_lengths(self, led_total: int):
+        strips = math.ceil(led_total / self.strip_length)
+        return {idx + 1: self.strip_length for idx in range(strips)}
+
+    def feed(self, vehicle_count: int, seed: int = 0, timestamp: int = 1700000000, configured_share: float = 0.5, elapsed: float = 0) -> bytes:
+        # The same seed always describes the same fleet, elapsed moves each vehicle along its route at its speed
+        rng = random.Random(seed)
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = '2.0'
+        feed.header.timestamp = timestamp
+        directions = list(self.directions())
+        span = self.stops_per_direction - 1
+        meters_per_stop = stop_spacing * meters_per_degree * math.cos(math.radians(origin[0]))
+        for number in range(vehicle_count):
+            entity = feed.entity.add()
+            entity.id = str(number)
+            vehicle = entity.vehicle
+            vehicle.vehicle.id = str(number)
+            vehicle.vehicle.label = 'S{}'.format(number)
+            vehicle.timestamp = timestamp - rng.randrange(30)
+            speed = rng.uniform(0, 15)
+            vehicle.position.speed = speed
+            if rng.random() >= configured_share:
+                # Somebody else's route, the decoder should drop it without looking further
+                vehicle.trip.route_id = str(noise_route_id)
+                vehicle.trip.trip_id = str(number)
+                vehicle.position.latitude = origin[0] - 0.5
+                vehicle.position.longitude = origin[1]
+                continue
+            route_index, direction = rng.choice(directions)
+            trip_number = rng.randrange(self.trips_per_direction)
+            along = (rng.uniform(0, span) + elapsed * speed / meters_per_stop) % span
+            reports_stop = rng.random() > 0.05
+            position = int(along) + 1
+            latitude, longitude = self.point_between(route_index, direction, position, along - int(along))
+            vehicle.trip.route_id = str(self.route_id(route_index))
+            vehicle.trip.trip_id = str(self.trip_id(route_index, direction, trip_number))
+            vehicle.trip.direction_id = direction
+            vehicle.position.latitude = latitude
+            vehicle.position.longitude = longitude
+            vehicle.current_stop_sequence = position + 1
+            # A few vehicles report no stop, as the real feed does
+            if reports_stop:
+                vehicle.stop_id = str(self.stop_code(route_index, direction, position))
+        return feed.SerializeToString()
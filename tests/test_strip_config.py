@@ -0,0 +1,104 @@
+import pickle
+import numpy as np
+import pytest
+from layout import compile_layout
+from strip_config import LightStatus, StripConfig
+
+EMPTY = LightStatus.EMPTY.value
+STATION = LightStatus.STATION.value
+OCCUPIED = LightStatus.OCCUPIED.value
+
+strip_lengths = {0: 8, 1: 6}
+led_config = {
+    '1': [{
+        'direction': 0,
+        'stops': [
+            {'code': 100, 'led': '0:0'},
+            {'code': 200, 'led': '0:4', 'loading': [
+                {'led': '0:3', 'percentage': 0.75},
+                {'led': '0:1', 'percentage': 0.25},
+                {'led': '0:2', 'percentage': 0.5},
+            ]},
+            {'code': 300, 'led': '1:5', 'loading': [
+                {'led': '1:4', 'percentage': 1.0},
+            ]},
+        ],
+    }],
+}
+
+
+@pytest.fixture
+def config():
+    return StripConfig(compile_layout(led_config, strip_lengths), strip_lengths)
+
+
+def lit(views) -> set:
+    return {(idx, int(led)) for idx, view in views.items() for led in np.flatnonzero(view == OCCUPIED)}
+
+
+def test_stations_are_in_base(config):
+    assert len(config) == 14
+    assert set(np.flatnonzero(config.base == STATION)) == {0, 4, 13}
+    assert config.prev_rows == [-1, 0, 1]
+
+
+def test_final_led_is_lit(config):
+    row = config.row('1', 0, 300)
+    views = config.calculate_strip([row], [], [])
+    assert views[1][5] == OCCUPIED
+    assert lit(views) == {(1, 5)}
+
+
+def test_first_stop_ignored_when_moving(config):
+    row = config.row('1', 0, 100)
+    assert config.prev_stop(row) is None
+    views = config.calculate_strip([], [row], [0.5])
+    assert lit(views) == set()
+    np.testing.assert_array_equal(config.status, config.base)
+
+
+@pytest.mark.parametrize('progress, led', [
+    (0.0, 1),
+    (0.25, 1),
+    (0.3, 2),
+    (0.5, 2),
+    (0.75, 3),
+    (0.99, 3),
+    (1.5, 3),
+])
+def test_loading_led_thresholds(config, progress, led):
+    row = config.row('1', 0, 200)
+    views = config.calculate_strip([], [row], [progress])
+    assert lit(views) == {(0, led)}
+
+
+def test_single_loading_led_is_used_for_any_progress(config):
+    row = config.row('1', 0, 300)
+    for progress in (0.0, 0.5, 1.0):
+        assert lit(config.calculate_strip([], [row], [progress])) == {(1, 4)}
+
+
+def test_previous_frame_is_reset_to_base(config):
+    first, second, last = (config.row('1', 0, code) for code in (100, 200, 300))
+    config.calculate_strip([first, last], [second], [0.4])
+    assert lit(config.views) == {(0, 0), (1, 5), (0, 2)}
+    views = config.calculate_strip([second], [], [])
+    assert lit(views) == {(0, 4)}
+    assert views[0][0] == STATION
+    assert views[0][2] == EMPTY
+    assert views[1][5] == STATION
+    config.calculate_strip([], [], [])
+    np.testing.assert_array_equal(config.status, config.base)
+
+
+def test_pickle_rebuilds_views(config):
+    config.calculate_strip([config.row('1', 0, 200)], [], [])
+    restored = pickle.loads(pickle.dumps(config))
+    np.testing.assert_array_equal(restored.status, restored.base)
+    assert len(restored.written) == 0
+    for idx, view in restored.views.items():
+        assert len(view) == strip_lengths[idx]
+        assert np.shares_memory(view, restored.status)
+    views = restored.calculate_strip([restored.row('1', 0, 300)], [restored.row('1', 0, 200)], [0.6])
+    assert lit(views) == {(1, 5), (0, 3)}
+    assert restored.status[13] == OCCUPIED
@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+
+MISSING = -1
+
+
+def parse_gtfs_times(values) -> np.ndarray:
+    # "HH:MM:SS" (hours can run past 24) to seconds after midnight, MISSING where blank.
+    # Done on the raw bytes, string splitting is most of the load time on a full stop_times.txt
+    raw = pd.Series(values, dtype=object).fillna('').astype(str).str.strip().to_numpy(dtype='S8')
+    chars = np.char.rjust(raw, 8).view(np.uint8).reshape(-1, 8)
+    valid = (chars[:, 2] == ord(':')) & (chars[:, 5] == ord(':'))
+    digits = np.where(chars == ord(' '), 0, chars.astype(np.int32) - ord('0'))
+    seconds = ((digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60
+               + digits[:, 6] * 10 + digits[:, 7])
+    return np.where(valid, seconds, MISSING).astype(np.int32)
+
+
+def format_gtfs_time(seconds: int):
+    if seconds == MISSING:
+        return None
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def optional_int(value):
+    value = int(value)
+    return None if value == MISSING else value
+
+
+def integer_column(frame, column: str, dtype) -> np.ndarray:
+    if column not in frame:
+        return np.full(len(frame), MISSING, dtype=dtype)
+    return pd.to_numeric(frame[column], errors='coerce').fillna(MISSING).to_numpy(dtype=dtype)
+
+
+def text_column(frame, column: str):
+    # Repeated strings (headsigns) as int32 codes into one list of distinct values
+    if column not in frame:
+        return np.full(len(frame), MISSING, dtype=np.int32), []
+    codes, uniques = pd.factorize(frame[column])
+    return codes.astype(np.int32), list(uniques)
+
+
+class TripTable:
+    """
+    trips.txt as a struct of NumPy arrays with an id-to-row index. Trip objects are
+    only built for the trips somebody asks for (see Route.GetTrip).
+    """
+
+    def __init__(self, frame: pd.DataFrame):
+        self.ids = integer_column(frame, 'trip_id', np.int64)
+        self.rows_by_id = {trip_id: row for row, trip_id in enumerate(self.ids.tolist())}
+        self.route_ids = integer_column(frame, 'route_id', np.int64)
+        self.service_codes, self.services = text_column(frame, 'service_id')
+        self.direction_ids = integer_column(frame, 'direction_id', np.int8)
+        self.block_ids = integer_column(frame, 'block_id', np.int64)
+        self.shape_ids = integer_column(frame, 'shape_id', np.int64)
+        self.peak_flags = integer_column(frame, 'peak_flag', np.int8)
+        self.fare_ids = integer_column(frame, 'fare_id', np.int32)
+        self.wheelchair = integer_column(frame, 'wheelchair_accessible', np.int8)
+        self.bikes = integer_column(frame, 'bikes_allowed', np.int8)
+        self.headsign_codes, self.headsigns = text_column(frame, 'trip_headsign')
+        self.short_name_codes, self.short_names = text_column(frame, 'trip_short_name')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, index: int) -> dict:
+        # The same keys as a trips.txt row, for building a Trip on demand
+        def text(codes, values):
+            code = codes[index]
+            return None if code == MISSING else values[code]
+
+        return {
+            'trip_id': int(self.ids[index]),
+            'route_id': int(self.route_ids[index]),
+            'service_id': text(self.service_codes, self.services),
+            'trip_headsign': text(self.headsign_codes, self.headsigns),
+            'trip_short_name': text(self.short_name_codes, self.short_names),
+            'direction_id': optional_int(self.direction_ids[index]),
+            'block_id': optional_int(self.block_ids[index]),
+            'shape_id': optional_int(self.shape_ids[index]),
+            'peak_flag': optional_int(self.peak_flags[index]),
+            'fare_id': optional_int(self.fare_ids[index]),
+            'wheelchair_accessible': optional_int(self.wheelchair[index]),
+            'bikes_allowed': optional_int(self.bikes[index]),
+        }
+
+    @staticmethod
+    def Read(path_or_buffer):
+        return TripTable(pd.read_csv(path_or_buffer, dtype={'service_id': 'string', 'trip_headsign': 'string',
+                                                            'trip_short_name': 'string'}))
+
+
+class StopTimeTable:
+    """
+    stop_times.txt as a struct of NumPy arrays, sorted by trip and stop_sequence,
+    in place of one TripStop object per row. The rows of a trip are contiguous:
+    offsets[i]:offsets[i + 1] for the trip at row i of trip_ids.
+    """
+
+    stop_times_columns = ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence', 'stop_headsign',
+                          'pickup_type', 'drop_off_type', 'shape_dist_traveled', 'timepoint']
+    array_columns = ['stop_ids', 'stop_sequences', 'arrivals', 'departures', 'pickup_types', 'drop_off_types',
+                     'timepoints', 'shape_dist_traveled', 'headsign_codes']
+
+    def __init__(self, trip_ids, columns: dict, headsigns: list):
+        # Rows can come in any order, they are grouped by trip here
+        order = np.lexsort((columns['stop_sequences'], trip_ids))
+        trip_ids = trip_ids[order]
+        for name in self.array_columns:
+            setattr(self, name, columns[name][order])
+        self.headsigns = headsigns
+        self.trip_ids, first_rows = np.unique(trip_ids, return_index=True)
+        self.offsets = np.append(first_rows, len(trip_ids)).astype(np.int64)
+        self.rows_by_trip = {trip_id: row for row, trip_id in enumerate(self.trip_ids.tolist())}
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def trip_rows(self, trip_id: int) -> range:
+        row = self.rows_by_trip.get(trip_id)
+        if row is None:
+            return range(0)
+        return range(self.offsets[row], self.offsets[row + 1])
+
+    def row(self, index: int, trip_id: int) -> dict:
+        # The same keys as a stop_times.txt row, for building a TripStop on demand
+        headsign_code = self.headsign_codes[index]
+        distance = float(self.shape_dist_traveled[index])
+        return {
+            'trip_id': trip_id,
+            'arrival_time': format_gtfs_time(int(self.arrivals[index])),
+            'departure_time': format_gtfs_time(int(self.departures[index])),
+            'stop_id': int(self.stop_ids[index]),
+            'stop_sequence': int(self.stop_sequences[index]),
+            'stop_headsign': None if headsign_code == MISSING else self.headsigns[headsign_code],
+            'pickup_type': optional_int(self.pickup_types[index]),
+            'drop_off_type': optional_int(self.drop_off_types[index]),
+            'shape_dist_traveled': None if np.isnan(distance) else distance,
+            'timepoint': optional_int(self.timepoints[index]),
+        }
+
+    @staticmethod
+    def Read(path_or_buffer, chunk_size: int = 200000):
+        # Each chunk is turned into typed arrays straight away, so neither the CSV text nor
+        # a full DataFrame of it is ever held in memory
+        header = pd.read_csv(path_or_buffer, nrows=0).columns
+        if hasattr(path_or_buffer, 'seek'):
+            path_or_buffer.seek(0)
+        usecols = [column for column in StopTimeTable.stop_times_columns if column in header]
+        dtypes = {column: object for column in ('arrival_time', 'departure_time', 'stop_headsign') if column in usecols}
+
+        headsign_codes = {}
+        trip_ids = []
+        columns = {name: [] for name in StopTimeTable.array_columns}
+        for chunk in pd.read_csv(path_or_buffer, usecols=usecols, dtype=dtypes, chunksize=chunk_size):
+            trip_ids.append(integer_column(chunk, 'trip_id', np.int64))
+            columns['stop_ids'].append(integer_column(chunk, 'stop_id', np.int64))
+            columns['stop_sequences'].append(integer_column(chunk, 'stop_sequence', np.int32))
+            columns['arrivals'].append(parse_gtfs_times(chunk['arrival_time']))
+            columns['departures'].append(parse_gtfs_times(chunk['departure_time']))
+            columns['pickup_types'].append(integer_column(chunk, 'pickup_type', np.int8))
+            columns['drop_off_types'].append(integer_column(chunk, 'drop_off_type', np.int8))
+            columns['timepoints'].append(integer_column(chunk, 'timepoint', np.int8))
+            if 'shape_dist_traveled' in chunk:
+                columns['shape_dist_traveled'].append(
+                    pd.to_numeric(chunk['shape_dist_traveled'], errors='coerce').to_numpy(dtype=np.float32))
+            else:
+                columns['shape_dist_traveled'].append(np.full(len(chunk), np.nan, dtype=np.float32))
+            if 'stop_headsign' in chunk:
+                # Codes have to agree across chunks, so they come from one running dict
+                codes = [MISSING if not isinstance(headsign, str) else headsign_codes.setdefault(headsign, len(headsign_codes))
+                         for headsign in chunk['stop_headsign'].tolist()]
+                columns['headsign_codes'].append(np.asarray(codes, dtype=np.int32))
+            else:
+                columns['headsign_codes'].append(np.full(len(chunk), MISSING, dtype=np.int32))
+
+        if not trip_ids:
+            return StopTimeTable(np.zeros(0, dtype=np.int64), {name: np.zeros(0) for name in StopTimeTable.array_columns}, [])
+        return StopTimeTable(np.concatenate(trip_ids), {name: np.concatenate(parts) for name, parts in columns.items()},
+                             list(headsign_codes))
@@ -1,11 +1,8 @@
-from google.transit import gtfs_realtime_pb2
-import requests
-from protobuf_to_dict import protobuf_to_dict
-import pandas as pd
 import io
 import zipfile
-from flatten_json import flatten
 import time
+# requests, pandas and the feed decoders are imported where they're used, the models
+# are needed at startup and the rest usually isn't
 
 
 def print_stopwatch(sec, msg):
@@ -16,6 +13,10 @@ def print_stopwatch(sec, msg):
   print("{0} = {1}:{2}:{3}".format(msg, int(hours),int(mins),sec))
 
 class Vehicle:
+    __slots__ = ('id', 'trip_id', 'start_date', 'route_id', 'direction_id', 'latitude',
+                 'longitude', 'stop_sequence', 'timestamp', 'stop_id', 'vehicle_id', 'label',
+                 'speed', 'status')
+
     def __init__(self, row):
         self.id = row.get('id')
         self.trip_id = int(row.get('vehicle.trip.trip_id'))
@@ -28,8 +29,9 @@ class Vehicle:
         self.timestamp = row.get('vehicle.timestamp')
         try:
             self.stop_id = int(row.get('vehicle.stop_id'))
-        except:
-            print()
+        except (TypeError, ValueError):
+            # Not every vehicle reports a stop, the app places those by position
+            self.stop_id = None
         self.vehicle_id = row.get('vehicle.vehicle.id')
         self.label = row.get('vehicle.vehicle.label')
         # self.bearing = row.get('vehicle.position.bearing')
@@ -37,6 +39,10 @@ class Vehicle:
         self.status = row.get('vehicle.current_status')
 
 class TripStop:
+    __slots__ = ('trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence',
+                 'stop_headsign', 'pickup_type', 'drop_off_type', 'shape_dist_traveled',
+                 'timepoint')
+
     def __init__(self, row):
         self.trip_id = row.get('trip_id')
         self.arrival_time = row.get('arrival_time')
@@ -50,6 +56,9 @@ class TripStop:
         self.timepoint = row.get('timepoint')
 
 class Stop:
+    __slots__ = ('id', 'code', 'name', 'description', 'latitude', 'longitude', 'zone_id',
+                 'stop_url', 'location_type', 'parent_station', 'timezone', 'wheelchair')
+
     def __init__(self, row):
         self.id = row.get('stop_id')
         self.code = row.get('stop_code')
@@ -75,9 +84,15 @@ class Stop:
 
 
 class Trip:
+    __slots__ = ('vehicles', 'trip_stops', 'stop_times', 'id', 'route_id', 'service_id',
+                 'headsign', 'short_name', 'direction_id', 'block_id', 'shape_id', 'peak',
+                 'fare_id', 'wheelchair', 'bikes')
+
     def __init__(self, row):
         self.vehicles = []
         self.trip_stops = {}
+        # StopTimeTable the trip's stops are read from, when it was loaded by ParseStaticFeed
+        self.stop_times = None
         self.id = row.get('trip_id')
         self.route_id = row.get('route_id')
         self.service_id = row.get('service_id')
@@ -101,16 +116,27 @@ class Trip:
         return self.vehicles
     
     def GetTripStops(self):
-        return self.trip_stops.copy()
+        trip_stops = {}
+        if self.stop_times is not None:
+            for index in self.stop_times.trip_rows(self.id):
+                trip_stop = TripStop(self.stop_times.row(index, self.id))
+                trip_stops[trip_stop.stop_id] = trip_stop
+        trip_stops.update(self.trip_stops)
+        return trip_stops
     
     def ClearVehicles(self):
         self.vehicles.clear()
 
 class Route:
+    __slots__ = ('trips', 'stops', 'trip_table', 'stop_times', 'id', 'agency_id', 'short_name',
+                 'long_name', 'description', 'type', 'url', 'color', 'text_color')
 
     def __init__(self, row):
         self.trips = {}
         self.stops = {}
+        # Set by ParseStaticFeed, trips are then built from the tables as they are asked for
+        self.trip_table = None
+        self.stop_times = None
         self.id = row.get('route_id')
         self.agency_id = row.get('agency_id')
         self.short_name = row.get('route_short_name')
@@ -139,7 +165,14 @@ class Route:
         return self.stops.copy()
 
     def GetTrip(self, trip_id):
-        return self.trips.get(trip_id)
+        trip = self.trips.get(trip_id)
+        if trip is None and self.trip_table is not None:
+            row = self.trip_table.rows_by_id.get(trip_id)
+            if row is not None and self.trip_table.route_ids[row] == self.id:
+                trip = Trip(self.trip_table.row(row))
+                trip.stop_times = self.stop_times
+                self.trips[trip.id] = trip
+        return trip
     
     def GetVehicles(self):
         vehicles = []
@@ -162,70 +195,80 @@ class TransitFeed:
         self.static_url = static_url
         self.realtime_url = realtime_url
         self.local_static_url = local_path
+        self.fetcher = None
 
     def GetStaticFeed(self):
+        import requests
         reqs = requests.get(self.static_url, allow_redirects=True)
         z = zipfile.ZipFile(io.BytesIO(reqs.content))
         z.extractall(self.local_static_url)
 
+    def DownloadStaticFeed(self, path):
+        # Streams the zip to disk instead of holding it in memory
+        import requests
+        with requests.get(self.static_url, allow_redirects=True, stream=True, timeout=(3.05, 60)) as reqs:
+            reqs.raise_for_status()
+            with open(path, 'wb') as zip_file:
+                for block in reqs.iter_content(chunk_size=1 << 20):
+                    zip_file.write(block)
+        return path
+
     def GetCurrentStatus(self):
+        from fetcher import FeedFetcher
+        from realtime import decode_vehicle_positions
+        if self.fetcher is None:
+            self.fetcher = FeedFetcher(self.realtime_url)
+        feed = self.fetcher.poll()
 
+        routes_by_name = {}
         for route in self.routes.values():
-            route.ClearVehicles()
+            routes_by_name[route.short_name] = route
 
-        feed = gtfs_realtime_pb2.FeedMessage()
-        response = requests.get(self.realtime_url, allow_redirects=True)
-        feed.ParseFromString(response.content)
+        # Unchanged feed, the vehicles from the last call are still current
+        if feed is None:
+            return routes_by_name
 
-        dict = protobuf_to_dict(feed)
+        for route in self.routes.values():
+            route.ClearVehicles()
 
-        zet_df = pd.DataFrame(flatten(record, '.')
-            for record in dict['entity'])
-        
-        for index, row in zet_df.iterrows():
+        batch = decode_vehicle_positions(feed, self.routes.keys())
+
+        for row in batch.rows():
             vehicle = Vehicle(row)
 
             route = self.routes[int(vehicle.route_id)]
             trip = route.GetTrip(int(vehicle.trip_id))
             trip.AddVehicle(vehicle)
 
-        routes_by_name = {}
-        for route in self.routes.values():
-            routes_by_name[route.short_name] = route
-
         return routes_by_name
 
         
     def ParseStaticFeed(self):
+        import pandas as pd
+        from timetable import TripTable, StopTimeTable
         start_time = time.time()
         print('Starting Parsing')
         routes_pd = pd.read_csv(self.local_static_url + '/routes.txt', sep=',')
         self.routes = {}
-        trips = {}
         print('...Routes')
-        for index, row in routes_pd.iterrows():
+        for row in routes_pd.to_dict('records'):
             route = Route(row)
             self.routes[route.id] = route
 
+        # Trips and stop times stay in column arrays, a Trip is only built when a route is asked for it
         print('...Trips')
-        trips_pd = pd.read_csv(self.local_static_url + '/trips.txt', sep=',')
-        for index, row in trips_pd.iterrows():
-            trip = Trip(row)
-            trips[trip.id] = trip
-            self.routes[trip.route_id].AddTrip(trip)
-        
+        self.trip_table = TripTable.Read(self.local_static_url + '/trips.txt')
+
         print('...Trip Stops')
-        trip_stops_pd = pd.read_csv(self.local_static_url + '/stop_times.txt')
-        for index, row in trip_stops_pd.iterrows():
-            trip_stop = TripStop(row)
-            trip = trips[trip_stop.trip_id]
-            trip.AddStop(trip_stop)
-            
+        self.stop_times = StopTimeTable.Read(self.local_static_url + '/stop_times.txt')
+        for route in self.routes.values():
+            route.trip_table = self.trip_table
+            route.stop_times = self.stop_times
 
         print('...Stops')
         stops_pd = pd.read_csv(self.local_static_url+'/stops.txt', sep=',')
         self.stops = {}
-        for index, row in stops_pd.iterrows():
+        for row in stops_pd.to_dict('records'):
             stop = Stop(row)
             self.stops[stop.id] = stop
         print_stopwatch(time.time() - start_time, 'Static GTFS feed parsed')
@@ -0,0 +1,76 @@
+import copy
+from collections import OrderedDict
+from typing import Optional
+from transit import Trip
+
+
+class TripIndex:
+    """
+    In-memory trip_id -> Trip lookup. Trips for the configured routes are loaded
+    once up front, anything else is fetched on a miss and the least recently
+    used entries are evicted once max_size is reached. Trip ids the database
+    doesn't know are kept too, as None, so they aren't looked up every poll.
+    """
+
+    def __init__(self, db, max_size: int = 8192):
+        self.db = db
+        self.max_size = max_size
+        self.trips = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.not_found = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # The database connection stays behind, whoever unpickles this sets db again
+        state = self.__dict__.copy()
+        state['db'] = None
+        return state
+
+    def copy(self):
+        # Same trips and counters, more routes can be loaded into the copy without touching this one
+        index = copy.copy(self)
+        # copy goes through __getstate__, which leaves the connection out
+        index.db = self.db
+        index.trips = OrderedDict(self.trips)
+        return index
+
+    def _put(self, trip_id: int, trip: Optional[Trip]):
+        self.trips[trip_id] = trip
+        self.trips.move_to_end(trip_id)
+        if len(self.trips) > self.max_size:
+            self.trips.popitem(last=False)
+            self.evictions += 1
+
+    def load_routes(self, route_ids):
+        trips = self.db.get_trips_by_route_ids(route_ids)
+        for trip in trips:
+            self._put(int(trip.id), trip)
+        return len(trips)
+
+    def get(self, trip_id: int):
+        if trip_id in self.trips:
+            trip = self.trips[trip_id]
+            if trip is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            self.trips.move_to_end(trip_id)
+            return trip
+        self.misses += 1
+        trip = self.db.get_trip_by_id(trip_id)
+        if trip is None:
+            self.not_found += 1
+        self._put(trip_id, trip)
+        return trip
+
+    def stats(self):
+        return {
+            'size': len(self.trips),
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'not_found': self.not_found,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,67 @@
+import json
+import os
+import threading
+
+
+class ConfigWatcher:
+    """
+    Watches a JSON file (strips.json) from a background thread by polling its
+    mtime and size, and calls on_change(config) with the parsed content whenever
+    it changes. A file that doesn't parse, e.g. one an editor is halfway through
+    saving, is skipped until it changes again.
+    """
+
+    def __init__(self, path: str, on_change, interval: float = 0.5):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.last_stat = self.stat()
+        self.reloads = 0
+        self.errors = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def check(self) -> bool:
+        stat = self.stat()
+        if stat is None or stat == self.last_stat:
+            return False
+        self.last_stat = stat
+        try:
+            with open(self.path) as json_data:
+                config = json.load(json_data)
+        except (OSError, ValueError) as e:
+            self.errors += 1
+            print('Ignoring unreadable {}: {}'.format(self.path, e))
+            return False
+        self.reloads += 1
+        self.on_change(config)
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                self.errors += 1
+                print('Reloading {} failed: {}'.format(self.path, e))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='config-watcher', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        return {
+            'reloads': self.reloads,
+            'errors': self.errors,
+        }
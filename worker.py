@@ -0,0 +1,390 @@
+"""
+Fetch and decode in a process of their own, so protobuf parsing and computing
+frames never hold the GIL of the process driving the strips.
+
+The worker polls the realtime feed on its PollScheduler, computes each snapshot's
+MotionFrame and publishes the frame's arrays into a FrameRing in shared memory.
+The app reads the newest frame, places the vehicles and moves them along by dead
+reckoning as usual.
+
+Frames are computed against the static data snapshot the app saved, checked
+against the key the app passes along, so the worker's StripConfig rows are the
+app's. The worker never builds static data itself: without a matching snapshot
+it exits with stale_snapshot and waits for the app to restart it.
+
+DecodeWorker starts it as a plain child process and restarts it when it exits or
+stops updating its heartbeat. The worker exits by itself once the app is gone.
+
+    python worker.py --ring NAME --snapshot PATH --snapshot-key KEY ...  (started by DecodeWorker)
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from metrics import Histogram, default_buckets
+
+# Vehicles per frame, beyond this a frame is cut short
+default_capacity = 4096
+# Exit code of a worker that found no snapshot under the key it was given
+stale_snapshot = 3
+# metrics stages the worker times, exported by the app as worker_<stage>
+worker_stages = ('fetch', 'parse', 'filter', 'resolve', 'compute')
+
+
+class FrameRing:
+    """
+    A ring of MotionFrame arrays in one shared memory block, one writer and one
+    reader. Every slot holds the arrays of a frame plus its sequence number; the
+    writer clears the sequence while rewriting a slot, and the reader checks it
+    again after copying, so a half-written frame is never used. The control
+    words also carry the worker's heartbeat and poll counters, and a block
+    after them its stage histograms (bucket counts, count, sum and max).
+    """
+
+    control_words = ('published', 'heartbeat', 'polls', 'failed_polls', 'vehicles_decoded')
+    stage_words = len(default_buckets) + 4
+    meta_words = ('sequence', 'generation', 'reported', 'stopped', 'moving')
+
+    def __init__(self, memory: shared_memory.SharedMemory, slots: int, capacity: int, owner: bool):
+        self.memory = memory
+        self.slots = slots
+        self.capacity = capacity
+        self.owner = owner
+        offset = 0
+
+        def array(shape, dtype):
+            nonlocal offset
+            view = np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset)
+            offset += view.nbytes
+            return view
+
+        self.control = array(len(self.control_words), np.int64)
+        self.stages = array((len(worker_stages), self.stage_words), np.float64)
+        self.meta = array((slots, len(self.meta_words)), np.int64)
+        self.stopped = array((slots, capacity), np.int32)
+        self.moving = array((slots, capacity), np.int32)
+        self.progress = array((slots, capacity), np.float64)
+        self.rates = array((slots, capacity), np.float64)
+        self.timestamps = array((slots, capacity), np.float64)
+
+    @staticmethod
+    def size(slots: int, capacity: int) -> int:
+        words = len(FrameRing.control_words) + len(worker_stages) * FrameRing.stage_words + slots * len(FrameRing.meta_words)
+        return 8 * words + slots * capacity * (4 + 4 + 8 + 8 + 8)
+
+    @staticmethod
+    def Create(slots: int = 4, capacity: int = default_capacity):
+        memory = shared_memory.SharedMemory(create=True, size=FrameRing.size(slots, capacity))
+        ring = FrameRing(memory, slots, capacity, True)
+        ring.control[:] = 0
+        ring.stages[:] = 0
+        ring.meta[:] = 0
+        return ring
+
+    @staticmethod
+    def Attach(name: str, slots: int, capacity: int):
+        memory = shared_memory.SharedMemory(name=name)
+        # Only the creating process may unlink the block, otherwise the resource tracker
+        # removes it as soon as this worker exits and a restarted one can't attach
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        return FrameRing(memory, slots, capacity, False)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def beat(self):
+        self.control[1] = time.monotonic_ns()
+
+    def heartbeat_age(self) -> float:
+        # Seconds since the worker last checked in, CLOCK_MONOTONIC is shared by all processes
+        return (time.monotonic_ns() - int(self.control[1])) / 1e9
+
+    def publish(self, generation: int, motion) -> bool:
+        # Returns False when the frame had to be cut short
+        sequence = int(self.control[0]) + 1
+        slot = sequence % self.slots
+        stopped = motion.stopped[:self.capacity]
+        moving = min(len(motion.moving), self.capacity)
+        meta = self.meta[slot]
+        meta[0] = 0
+        meta[1] = generation
+        meta[2] = motion.reported
+        meta[3] = len(stopped)
+        meta[4] = moving
+        self.stopped[slot, :len(stopped)] = stopped
+        self.moving[slot, :moving] = motion.moving[:moving]
+        self.progress[slot, :moving] = motion.progress[:moving]
+        self.rates[slot, :moving] = motion.rates[:moving]
+        self.timestamps[slot, :moving] = motion.timestamps[:moving]
+        meta[0] = sequence
+        self.control[0] = sequence
+        return len(stopped) == len(motion.stopped) and moving == len(motion.moving)
+
+    def read(self, after: int):
+        """
+        The newest frame published after sequence number after, as (sequence,
+        generation, reported, stopped, moving, progress, rates, timestamps),
+        or None when there is none or it is being rewritten.
+        """
+        sequence = int(self.control[0])
+        if sequence <= after:
+            return None
+        slot = sequence % self.slots
+        if self.meta[slot, 0] != sequence:
+            return None
+        generation, reported, stopped, moving = (int(value) for value in self.meta[slot, 1:])
+        frame = (sequence, generation, reported, self.stopped[slot, :stopped].copy(), self.moving[slot, :moving].copy(),
+                 self.progress[slot, :moving].copy(), self.rates[slot, :moving].copy(), self.timestamps[slot, :moving].copy())
+        if self.meta[slot, 0] != sequence:
+            return None
+        return frame
+
+    def publish_stages(self, registry):
+        # Copies the worker's stage histograms over, the app may read one that is half updated
+        for row, stage in zip(self.stages, worker_stages):
+            histogram = registry.stages.get(stage)
+            if histogram is not None:
+                row[:] = histogram.counts + [histogram.count, histogram.sum, histogram.max]
+
+    def read_stages(self) -> dict:
+        histograms = {}
+        for row, stage in zip(self.stages, worker_stages):
+            histogram = Histogram()
+            values = row.tolist()
+            bucket_count = len(histogram.counts)
+            histogram.counts = [int(count) for count in values[:bucket_count]]
+            histogram.count = int(values[bucket_count])
+            histogram.sum, histogram.max = values[bucket_count + 1:bucket_count + 3]
+            if histogram.count:
+                histograms[stage] = histogram
+        return histograms
+
+    def close(self):
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class DecodeWorker:
+    """
+    Runs worker.py in a child process and keeps it running: a worker that exits,
+    or whose heartbeat is older than hang_timeout, is killed and started again
+    (at most every restart_delay seconds). The display keeps animating the last
+    frame in the meantime.
+
+    Frames are tagged with the generation the worker was started with, and every
+    generation belongs to one StaticData. Restarting with the reloaded static
+    data bumps it, and latest() hands out each frame with the StaticData it was
+    computed against, so old frames are never placed on a new layout.
+
+    The app has to have saved that StaticData's snapshot (load_static and
+    save_static do) before handing it to start() or restart(). A worker that
+    finds no such snapshot isn't restarted until the next restart(data).
+    """
+
+    def __init__(self, args: list, snapshot_path: str = None, slots: int = 4, capacity: int = default_capacity,
+                 hang_timeout: float = 60, restart_delay: float = 5):
+        # Command line arguments for worker.py other than the ring's and the static data's
+        self.args = args
+        self.snapshot_path = snapshot_path
+        self.ring = FrameRing.Create(slots, capacity)
+        self.hang_timeout = hang_timeout
+        self.restart_delay = restart_delay
+        self.generation = 0
+        self.data = None
+        self.process = None
+        self.started_at = 0.0
+        self.last_read = 0
+        self.restarts = 0
+        self.frames = 0
+        self.stale_frames = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def spawn(self):
+        from snapshot import snapshot_location
+
+        snapshot_path, key = snapshot_location(self.data, self.snapshot_path)
+        self.ring.beat()
+        self.started_at = time.monotonic()
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                         '--ring', self.ring.name, '--slots', str(self.ring.slots),
+                                         '--capacity', str(self.ring.capacity), '--generation', str(self.generation),
+                                         '--parent', str(os.getpid()), '--gtfs-db', self.data.db.path,
+                                         '--snapshot', snapshot_path, '--snapshot-key', key]
+                                        + self.args)
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def restart(self, data=None, reason: str = None):
+        # With data, after a static reload, otherwise because the worker died or hung
+        with self.lock:
+            if reason is not None:
+                print('Restarting decode worker: {}'.format(reason))
+                self.restarts += 1
+            self.kill()
+            if data is not None:
+                self.generation += 1
+                self.data = data
+            self.spawn()
+
+    def check(self):
+        if time.monotonic() - self.started_at < self.restart_delay:
+            return
+        code = self.process.poll()
+        if code == stale_snapshot:
+            # Starting it again can't help, the next restart(data) brings a new snapshot
+            return
+        if code is not None:
+            self.restart(reason='exited with {}'.format(code))
+        elif self.ring.heartbeat_age() > self.hang_timeout:
+            self.restart(reason='no heartbeat for {:.0f}s'.format(self.ring.heartbeat_age()))
+
+    def run(self):
+        while not self.stopped.wait(1):
+            self.check()
+
+    def start(self, data):
+        with self.lock:
+            self.data = data
+            self.spawn()
+        self.thread = threading.Thread(target=self.run, name='decode-worker', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            self.kill()
+        self.ring.close()
+
+    def latest(self):
+        # (StaticData, (stopped, moving, progress, rates, timestamps, reported)) of the newest frame, or None
+        frame = self.ring.read(self.last_read)
+        if frame is None:
+            return None
+        self.last_read = frame[0]
+        with self.lock:
+            if frame[1] != self.generation:
+                self.stale_frames += 1
+                return None
+            self.frames += 1
+            return self.data, frame[3:] + frame[2:3]
+
+    def stage_histograms(self):
+        # The worker's fetch to compute stage timings, see Metrics.register_stages
+        return self.ring.read_stages()
+
+    def stats(self):
+        return {
+            'pid': self.process.pid if self.process is not None else 0,
+            'generation': self.generation,
+            'restarts': self.restarts,
+            'frames': self.frames,
+            'stale_frames': self.stale_frames,
+            'heartbeat_age': self.ring.heartbeat_age(),
+            'polls': int(self.ring.control[2]),
+            'failed_polls': int(self.ring.control[3]),
+            'vehicles_decoded': int(self.ring.control[4]),
+        }
+
+
+def run_worker(args):
+    from fetcher import FeedFetcher
+    from feed_cache import save_batch
+    from frames import group_vehicles, compute_motion
+    from gtfs_db import GtfsDatabase
+    from metrics import metrics
+    from realtime import decode_vehicle_positions
+    from scheduler import PollScheduler
+    from snapshot import load_snapshot
+
+    ring = FrameRing.Attach(args.ring, args.slots, args.capacity)
+    ring.beat()
+    # Always on, the app decides whether to export what ends up in the ring. A restarted
+    # worker starts its histograms over, like the app's after a restart.
+    metrics.enabled = True
+    ring.stages[:] = 0
+
+    def orphaned():
+        # The app died without stopping us (SIGKILL, OOM killer), nobody reads the ring any more
+        if os.getppid() == args.parent:
+            return False
+        print('Decode worker exiting, parent {} is gone'.format(args.parent))
+        ring.close()
+        return True
+
+    # The app holds the display, an interrupt is for it to handle
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    data = load_snapshot(args.snapshot, args.snapshot_key)
+    if data is None:
+        # Whatever is on disk was built for another strips.json or database than the app's
+        print('Decode worker exiting, no snapshot in {} matches the app\'s static data'.format(args.snapshot))
+        ring.close()
+        sys.exit(stale_snapshot)
+    data.attach(GtfsDatabase(args.gtfs_db))
+    fetcher = FeedFetcher(args.url)
+    scheduler = PollScheduler(fetcher, args.interval, service=lambda: data.service)
+
+    while not orphaned():
+        ring.beat()
+        failed = False
+        motion = None
+        ring.control[2] += 1
+        try:
+            feed = fetcher.poll()
+            if feed is not None:
+                with metrics.time('filter'):
+                    batch = decode_vehicle_positions(feed, data.routes_by_id.keys())
+                ring.control[4] += len(batch)
+                with metrics.time('resolve'):
+                    vehicles_by_route = group_vehicles(data, batch)
+                with metrics.time('compute'):
+                    motion = compute_motion(data, vehicles_by_route, log=None, reported=batch.timestamp)
+                if not ring.publish(args.generation, motion):
+                    print('Frame cut short at {} vehicles'.format(ring.capacity))
+                if args.feed_cache:
+                    try:
+                        save_batch(args.feed_cache, batch)
+                    except OSError as e:
+                        print('Could not write feed cache {}: {}'.format(args.feed_cache, e))
+        except Exception as e:
+            failed = True
+            ring.control[3] += 1
+            print('Feed poll failed: {}'.format(e))
+        ring.publish_stages(metrics)
+        # Sleep in short steps so the heartbeat only stops when the worker is really stuck
+        deadline = time.monotonic() + scheduler.after_poll(motion is not None, failed)
+        while time.monotonic() < deadline and os.getppid() == args.parent:
+            ring.beat()
+            time.sleep(min(1.0, max(deadline - time.monotonic(), 0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ring', required=True, help='Name of the FrameRing shared memory block')
+    parser.add_argument('--slots', type=int, default=4)
+    parser.add_argument('--capacity', type=int, default=default_capacity)
+    parser.add_argument('--generation', type=int, default=0)
+    parser.add_argument('--parent', type=int, required=True, help='Pid of the app, the worker exits when it is gone')
+    parser.add_argument('--gtfs-db', required=True)
+    parser.add_argument('--snapshot', required=True, help='Static snapshot the app saved')
+    parser.add_argument('--snapshot-key', required=True, help='Key the app saved it under, see snapshot.py')
+    parser.add_argument('--feed-cache', help='Keep the last decoded feed here, see feed_cache.py')
+    parser.add_argument('--url', required=True, help='GTFS-realtime VehiclePositions URL')
+    parser.add_argument('--interval', type=float, default=8, help='Base poll interval in seconds')
+    run_worker(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()